@@ -1,11 +1,13 @@
+import heapq
 import os
-import platform
+import threading
 from enum import Enum
-from urllib.parse import quote
+from functools import lru_cache
+from operator import itemgetter
 from typing import List, Dict, Union, Optional
 from abc import ABC, abstractmethod
-from datetime import datetime
-from unicodedata import normalize
+from dataclasses import dataclass
+from datetime import datetime, date
 
 from pydantic import BaseModel, field_validator
 
@@ -14,6 +16,10 @@ from logger import setup_logger
 
 logger = setup_logger(__name__)
 
+# Resolved once, neither changes while the process runs
+_ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+_LIBRARY_DIR = os.path.join(_ROOT_DIR, "library_files")
+
 class MatchLogic(str, Enum):
     # Match logic options for keyword searches
     AND = "AND"
@@ -50,8 +56,36 @@ class SearchCriteria(BaseModel):
             return MatchLogic.from_string(value)
         return value
 
+@dataclass(frozen=True, slots=True)
+class CompiledCriteria:
+    # Query values normalized once per search, so the record loops don't redo it per record
+    keywords: tuple  # (original, normalized) pairs
+    publisher: str
+    title: str
+    content: str
+    start_date: Optional[date]
+    end_date: Optional[date]
+    has_date_range: bool
+
+    @classmethod
+    def from_criteria(cls, criteria: SearchCriteria) -> 'CompiledCriteria':
+        return cls(
+            keywords=tuple((kw, kw.strip().lower()) for kw in criteria.keywords),
+            publisher=criteria.publisher.strip().lower(),
+            title=criteria.title.strip().lower(),
+            content=criteria.content.strip().lower(),
+            start_date=criteria.start_date.date() if criteria.start_date else None,
+            end_date=criteria.end_date.date() if criteria.end_date else None,
+            has_date_range=bool(criteria.start_date or criteria.end_date),
+        )
+
 
 class BaseAgent(ABC):
+    # Models are stateless wrappers around the TinyDB singleton, so every agent shares one of each
+    _shared_file_model = None
+    _shared_content_model = None
+    _model_lock = threading.Lock()
+
     def __init__(self):
         self._file_model = None
         self._content_model = None
@@ -59,21 +93,29 @@ class BaseAgent(ABC):
     @property
     def file_model(self):
         if self._file_model is None:
-            try:
-                self._file_model = FileModel()
-            except Exception as e:
-                logger.error(f"FileModel initialization failed: {str(e)}")
-                raise
+            if BaseAgent._shared_file_model is None:
+                with BaseAgent._model_lock:
+                    if BaseAgent._shared_file_model is None:
+                        try:
+                            BaseAgent._shared_file_model = FileModel()
+                        except Exception as e:
+                            logger.error(f"FileModel initialization failed: {str(e)}")
+                            raise
+            self._file_model = BaseAgent._shared_file_model
         return self._file_model
 
     @property
     def content_model(self):
         if self._content_model is None:
-            try:
-                self._content_model = ContentModel()
-            except Exception as e:
-                logger.error(f"ContentModel initialization failed: {str(e)}")
-                raise
+            if BaseAgent._shared_content_model is None:
+                with BaseAgent._model_lock:
+                    if BaseAgent._shared_content_model is None:
+                        try:
+                            BaseAgent._shared_content_model = ContentModel()
+                        except Exception as e:
+                            logger.error(f"ContentModel initialization failed: {str(e)}")
+                            raise
+            self._content_model = BaseAgent._shared_content_model
         return self._content_model
 
     @abstractmethod
@@ -82,40 +124,17 @@ class BaseAgent(ABC):
         pass
 
     @staticmethod
-    def _normalize_text(text: str) -> str:
-        # Normalize text: lowercase, remove accents, punctuation, standardize spaces
-        normalized = normalize('NFKD', text).encode('ascii', 'ignore').decode('utf-8')
-        normalized = normalized.lower()
-        normalized = ''.join(c if c.isalnum() or c.isspace() else ' ' for c in normalized)
-        return ' '.join(normalized.split())
-
-    @staticmethod
-    def _parse_date(date: Union[datetime, str]) -> datetime:
-        # Parse date for sorting, return datetime.min if invalid
+    @lru_cache(maxsize=4096)
+    def _parse_date_str(date: str) -> Optional[datetime]:
+        # Parse ISO date string, cached since the same published dates recur on every query
         try:
-            return datetime.fromisoformat(date) if isinstance(date, str) else date
+            if 'T' in date:
+                return datetime.fromisoformat(date)
+            elif len(date) == 10:
+                return datetime.strptime(date, "%Y-%m-%d")
+            return datetime.fromisoformat(date)
         except (ValueError, TypeError):
-            return datetime.min
-
-    @staticmethod
-    def _path2uri(file_path: str):
-        # Convert file path to URI
-        try:
-            system = platform.system()
-            file_name = os.path.basename(file_path)
-            custom_root = os.path.dirname(os.path.abspath(__file__)).replace("\\", "/")
-            file_path = os.path.join(custom_root, "library_files", file_name)  # type: ignore
-            if os.path.isfile(file_path):
-                if system == "Windows":
-                    uri_path = file_path.replace("\\", "/")
-                    if ":" in uri_path:
-                        drive, path_without_drive = uri_path.split(":", 1)
-                        uri_path = f"/{drive}:{path_without_drive}"
-                    return "file://" + quote(uri_path)  # type: ignore
-                return "file://" + quote(file_path)  # type: ignore
-            return None
-        except Exception as e:
-            logger.error(f"File path conversion failed: {e}")
+            logger.warning(f"Date parsing failed: {date}")
             return None
 
     @staticmethod
@@ -124,11 +143,10 @@ class BaseAgent(ABC):
         try:
             if not file_path or not isinstance(file_path, str):
                 return None
-            custom_root = os.path.dirname(os.path.abspath(__file__))
-            file_name = os.path.basename(file_path)
-            full_path = os.path.join(custom_root, "library_files", file_name)
+            # _LIBRARY_DIR is absolute and normalized, joining a bare file name keeps it that way
+            full_path = os.path.join(_LIBRARY_DIR, os.path.basename(file_path))
             if os.path.isfile(full_path):
-                return os.path.normpath(full_path)
+                return full_path
             return None
         except Exception as e:
             logger.error(f"File path conversion failed for '{file_path}': {e}")
@@ -140,57 +158,39 @@ class BaseRetriever(BaseAgent):
         self.max_results = max_results
 
     def run(self, criteria: SearchCriteria, idx: int = 1) -> Dict:
+        # Semantic search reads the same indexes from a worker thread and may rebuild them
+        with self.file_model.locked():
+            return self._run(criteria, idx)
+
+    def _run(self, criteria: SearchCriteria, idx: int = 1) -> Dict:
         pass
 
     @staticmethod
-    def _match_keywords(target_keywords: List[str], criteria: SearchCriteria) -> tuple[bool, List[str]]:
-        # Match keywords with AND/OR logic, return match status and matched keywords
-        if not criteria.keywords:
-            return True, []
-        matched_keywords = []
-        for query_kw in criteria.keywords:
-            clean_query = query_kw.strip()
-            found = False
-            for target_kw in target_keywords:
-                clean_target = target_kw.strip()
-                if clean_query == clean_target or clean_query.lower() == clean_target.lower():
-                    found = True
-                    matched_keywords.append(query_kw)
-                    break
-            if criteria.match_logic == "AND" and not found:
-                return False, []
-        if criteria.match_logic == "OR" and not matched_keywords:
-            return False, []
-        return True, matched_keywords
+    def _matched_keywords(doc_id: int, compiled: CompiledCriteria, postings: List[set]) -> List[str]:
+        # Query keywords whose index postings contain the record, in the query's order and spelling.
+        # AND/OR is already applied by the index lookup that produced the candidates.
+        return [query_kw for (query_kw, _), doc_ids in zip(compiled.keywords, postings) if doc_id in doc_ids]
+
+    @staticmethod
+    def _match_text(target_text: str, query: str) -> bool:
+        # Case-insensitive text matching, both sides already lowercased (targets once per snapshot)
+        return not query or query in target_text
 
     @staticmethod
-    def _match_text(target_text: str, search_text: str) -> bool:
-        # Case-insensitive text matching
-        return search_text.strip().lower() in target_text.lower() if search_text.strip() else True
+    def _sorted_page(matches: List[tuple], sort_key, start: int, end: int) -> List[tuple]:
+        # Descending-sorted matches[start:end]; only the top `end` are ordered when that's fewer than all.
+        # nlargest is documented as equivalent to sorted(..., reverse=True)[:n], ties keep their order.
+        if end < len(matches):
+            return heapq.nlargest(end, matches, key=sort_key)[start:]
+        return sorted(matches, key=sort_key, reverse=True)[start:end]
 
     @staticmethod
-    def _match_date(target_date: Union[datetime, str], criteria: SearchCriteria) -> bool:
-        # Match date against criteria range
-        if isinstance(target_date, str):
-            try:
-                if 'T' in target_date:
-                    dt = datetime.fromisoformat(target_date)
-                elif len(target_date) == 10:
-                    dt = datetime.strptime(target_date, "%Y-%m-%d")
-                else:
-                    dt = datetime.fromisoformat(target_date)
-                target_date = dt
-            except (ValueError, TypeError):
-                logger.warning(f"Date parsing failed: {target_date}")
-                return False
-        target_date = target_date.date() if isinstance(target_date, datetime) else None
-        if not target_date:
-            return False
-        if criteria.start_date and target_date < criteria.start_date.date():
-            return False
-        if criteria.end_date and target_date > criteria.end_date.date():
-            return False
-        return True
+    def _published_at(file: Dict) -> Optional[datetime]:
+        # Parse a file's published date once per query, shared by the date filter and the sort key
+        published_date = file.get("published_date")
+        if isinstance(published_date, str):
+            return BaseAgent._parse_date_str(published_date)
+        return published_date
 
     @staticmethod
     def _path2url(file_path: str) -> str:
@@ -198,92 +198,89 @@ class BaseRetriever(BaseAgent):
         normalized_path = file_path.replace('\\', '/')
         return prefix_url + normalized_path
 
+    def _file_location(self, file: Dict) -> tuple[Optional[str], Optional[str]]:
+        # Local path for uploaded files, download URL for admin reports
+        if file.get("uploader") != "admin":
+            return self._full_path(file.get("file_path")), None
+        return None, self._path2url(file.get("file_path"))
+
 class FileRetriever(BaseRetriever):
     def __init__(self, max_results: int = 2):
         super().__init__(max_results)
 
-    def _get_all_files(self) -> List[Dict]:
-        # Fetch all file records
-        return self.file_model.get_all_files()
-
-    def run(self, criteria: SearchCriteria, idx: int = 1) -> Dict:
+    def _get_candidate_doc_ids(self, criteria: SearchCriteria, compiled: CompiledCriteria) -> Optional[set]:
+        # Narrow files via the tag/publisher/date indexes, None if no indexed criteria are set
+        doc_ids = None
+        if criteria.keywords:
+            doc_ids = self.file_model.get_doc_ids_by_tags(criteria.keywords, criteria.match_logic is MatchLogic.AND)
+        if compiled.publisher:
+            publisher_ids = self.file_model.get_doc_ids_by_publisher(compiled.publisher)
+            doc_ids = publisher_ids if doc_ids is None else doc_ids & publisher_ids
+        if compiled.has_date_range:
+            date_ids = self.file_model.get_doc_ids_by_date_range(compiled.start_date, compiled.end_date)
+            doc_ids = date_ids if doc_ids is None else doc_ids & date_ids
+        return doc_ids
+
+    def _build_result(self, file: Dict, matched_kws: List[str]) -> Dict:
+        # Build a result entry (records are shared snapshot entries, so don't mutate them)
+        local_path, download_url = self._file_location(file)
+        return {
+            "file_name": file.get("file_name", ""),
+            "topic": file.get("topic"),
+            "content": file.get("file_desc", ""),
+            "published_by": file.get("source", ""),
+            "published_date": file.get("published_date"),
+            "local_path": local_path,
+            "download_url": download_url,
+            "matched_keywords": matched_kws
+        }
+
+    def _run(self, criteria: SearchCriteria, idx: int = 1) -> Dict:
         try:
             # Validate page index
             if idx < 1:
                 logger.error(f"Invalid page index: {idx}. Must be >= 1")
                 return {"results": [], "current_page": idx, "total_pages": 0, "total_matches": 0}
 
-            # Fetch all files
-            files = self._get_all_files()
-            if not files:
-                logger.error("No file records in database")
+            # Fetch processed candidate files from the indexes, or all processed files
+            compiled = CompiledCriteria.from_criteria(criteria)
+            tag_postings = self.file_model.get_tag_postings(criteria.keywords) if criteria.keywords else []
+            doc_ids = self._get_candidate_doc_ids(criteria, compiled)
+            files = self.file_model.query_files(doc_ids, opt_msg="processed")
+            if not files and doc_ids is None:
+                logger.error("No processed file records in database")
                 return {"results": [], "current_page": idx, "total_pages": 0, "total_matches": 0}
 
-            # Full path or URL
-            for file in files:
-                if file.get("uploader") != "admin":
-                    file["full_path"] = self._full_path(file.get("file_path"))
-                else:
-                    file["download_url"] = self._path2url(file.get("file_path"))
-
             # Process files with optimized filtering
-            results = []
+            matches = []
             for file in files:
-                # Check if file is processed
-                if file.get("opt_msg") != "processed":
-                    continue
-
-                # Date filter (skip if no date criteria)
-                if (criteria.start_date or criteria.end_date) and not self._match_date(file.get("published_date"), criteria):
-                    continue
+                # Date range already applied by the date index, parsed here for the sort key
+                published = self._published_at(file)
 
                 # Publisher filter (skip if empty)
-                publisher = file.get("source", "")
-                if criteria.publisher and not self._match_text(publisher, criteria.publisher):
+                if compiled.publisher and not self._match_text(self.file_model.lowered(file, "source"), compiled.publisher):
                     continue
 
                 # Title filter (skip if empty)
-                title = file.get("file_name", "")
-                if criteria.title and not self._match_text(title, criteria.title):
+                if compiled.title and not self._match_text(self.file_model.lowered(file, "file_name"), compiled.title):
                     continue
 
-                # Keyword filter (skip if empty)
-                file_tags = file.get("tags", [])
-                if criteria.keywords:
-                    match_ok, matched_kws = self._match_keywords(file_tags, criteria)
-                    if not match_ok:
-                        continue
-                else:
-                    matched_kws = []
+                # Matched keywords (the tag index already filtered the candidates)
+                matched_kws = self._matched_keywords(file.doc_id, compiled, tag_postings)
 
                 # Content filter (skip if empty)
-                content = file.get("file_desc", "")
-                if criteria.content and not self._match_text(content, criteria.content):
+                if compiled.content and not self._match_text(self.file_model.lowered(file, "file_desc"), compiled.content):
                     continue
 
-                # Build result
-                results.append({
-                    "file_name": title,
-                    "topic": file.get("topic"),
-                    "content": content,
-                    "published_by": publisher,
-                    "published_date": file.get("published_date"),
-                    "local_path": file.get("full_path", None),
-                    "download_url": file.get("download_url", None),
-                    "matched_keywords": matched_kws
-                })
-
-            # Sort results
-            if criteria.keywords:
-                # Sort by number of matched keywords (descending)
-                results = sorted(results, key=lambda x: len(x["matched_keywords"]), reverse=True)
-            else:
-                # Sort by published_date (descending)
-                results = sorted(results, key=lambda x: self._parse_date(x["published_date"]), reverse=True)
+                # Result dicts are only built for the requested page
+                matches.append((file, matched_kws, published or datetime.min))
+
+            # Sort key: number of matched keywords, else published_date (both descending)
+            sort_key = (lambda x: len(x[1])) if criteria.keywords else itemgetter(2)
 
             # Pagination
             page_size = self.max_results
-            total_matches = len(results)
+            total_matches = len(matches)
             total_pages = (total_matches + page_size - 1) // page_size
 
             # Validate page index against total pages
@@ -294,7 +291,7 @@ class FileRetriever(BaseRetriever):
             # Slice results for the requested page
             start = (idx - 1) * page_size
             end = start + page_size
-            paginated_results = results[start:end]
+            paginated_results = [self._build_result(file, matched_kws) for file, matched_kws, _ in self._sorted_page(matches, sort_key, start, end)]
 
             return {
                 "results": paginated_results,
@@ -311,102 +308,95 @@ class ContentRetriever(BaseRetriever):
     def __init__(self, max_results: int = 5):
         super().__init__(max_results)
 
-    def _get_file_info(self, file_id: str) -> Dict:
-        # Retrieve file info by file_id
-        return self.file_model.get_file_by_id(file_id)
-
-    def _get_all_contents(self) -> List[Dict]:
-        # Fetch all content records
-        return self.content_model.contents.all()
-
-    def run(self, criteria: SearchCriteria, idx: int = 1) -> Dict:
+    def _get_eligible_files(self, compiled: CompiledCriteria) -> Dict[str, tuple]:
+        # Evaluate file-level filters (date, publisher, title) once per file: {file_id: (file, sort date)}
+        doc_ids = self.file_model.get_doc_ids_by_publisher(compiled.publisher) if compiled.publisher else None
+        if compiled.has_date_range:
+            date_ids = self.file_model.get_doc_ids_by_date_range(compiled.start_date, compiled.end_date)
+            doc_ids = date_ids if doc_ids is None else doc_ids & date_ids
+        eligible_files = {}
+        for file in self.file_model.query_files(doc_ids):
+            published = self._published_at(file)
+            if compiled.publisher and not self._match_text(self.file_model.lowered(file, "source"), compiled.publisher):
+                continue
+            if compiled.title and not self._match_text(self.file_model.lowered(file, "file_name"), compiled.title):
+                continue
+            eligible_files[file["file_id"]] = (file, published or datetime.min)
+        return eligible_files
+
+    def _get_candidate_doc_ids(self, criteria: SearchCriteria, eligible_files: Dict[str, tuple]) -> Optional[set]:
+        # Narrow contents via the keyword index and the eligible files, None if nothing narrows them
+        doc_ids = None
+        if criteria.keywords:
+            doc_ids = self.content_model.get_doc_ids_by_keywords(criteria.keywords, criteria.match_logic is MatchLogic.AND)
+        if criteria.publisher.strip() or criteria.title.strip() or criteria.start_date or criteria.end_date:
+            file_doc_ids = self.content_model.get_doc_ids_by_file_ids(list(eligible_files))
+            doc_ids = file_doc_ids if doc_ids is None else doc_ids & file_doc_ids
+        return doc_ids
+
+    def _build_result(self, content: Dict, file_info: Dict, matched_kws: List[str], file_locations: Dict) -> Dict:
+        # Build a result entry, resolving each file's location once per page
+        file_id = content.get("file_id")
+        if file_id not in file_locations:
+            file_locations[file_id] = self._file_location(file_info)
+        local_path, download_url = file_locations[file_id]
+        return {
+            "file_name": file_info.get("file_name", ""),
+            "page_number": content.get("page_number"),
+            "page_abstract": content.get("abstract"),
+            "page_content": content.get("content", ""),
+            "page_keywords": content.get("keywords", []),
+            "published_by": file_info.get("source", ""),
+            "published_date": file_info.get("published_date"),
+            "local_path": local_path,
+            "download_url": download_url,
+            "matched_keywords": matched_kws
+        }
+
+    def _run(self, criteria: SearchCriteria, idx: int = 1) -> Dict:
         try:
             # Validate page index
             if idx < 1:
                 logger.error(f"Invalid page index: {idx}. Must be >= 1")
                 return {"results": [], "current_page": idx, "total_pages": 0, "total_matches": 0}
 
-            # Fetch all contents
-            contents = self._get_all_contents()
-            if not contents:
-                logger.error("No content records in database")
-                return {"results": [], "current_page": idx, "total_pages": 0, "total_matches": 0}
+            # Files passing the file-level filters
+            compiled = CompiledCriteria.from_criteria(criteria)
+            eligible_files = self._get_eligible_files(compiled)
 
-            # Cache file info and precompute URIs
-            all_files = self.file_model.get_all_files()
-            file_info_map = {file["file_id"]: file for file in all_files}
-            for file in file_info_map.values():
-                if file.get("uploader") != "admin":
-                    file["full_path"] = self._full_path(file.get("file_path"))
-                else:
-                    file["download_url"] = self._path2url(file.get("file_path"))
+            # Fetch main candidate contents from the indexes, or all main contents
+            keyword_postings = self.content_model.get_keyword_postings(criteria.keywords) if criteria.keywords else []
+            doc_ids = self._get_candidate_doc_ids(criteria, eligible_files)
+            contents = self.content_model.query_contents(doc_ids, property="main")
+            if not contents and doc_ids is None:
+                logger.error("No main content records in database")
+                return {"results": [], "current_page": idx, "total_pages": 0, "total_matches": 0}
 
             # Process contents with optimized filtering
-            results = []
+            matches = []
             for content in contents:
-                # Check if property is main
-                if content.get("property") != "main":
-                    continue
-
-                # Get file info
-                file_id = content.get("file_id")
-                if not file_id or file_id not in file_info_map:
-                    continue
-                file_info = file_info_map[file_id]
-
-                # Date filter (skip if no date criteria)
-                if (criteria.start_date or criteria.end_date) and not self._match_date(file_info.get("published_date"), criteria):
-                    continue
-
-                # Publisher filter (skip if empty)
-                publisher = file_info.get("source", "")
-                if criteria.publisher and not self._match_text(publisher, criteria.publisher):
+                # Get file info (date, publisher and title already filtered per file)
+                eligible = eligible_files.get(content.get("file_id"))
+                if eligible is None:
                     continue
+                file_info, published = eligible
 
-                # Title filter (skip if empty)
-                title = file_info.get("file_name", "")
-                if criteria.title and not self._match_text(title, criteria.title):
-                    continue
-
-                # Keyword filter (skip if empty)
-                content_keywords = content.get("keywords", [])
-                if criteria.keywords:
-                    match_ok, matched_kws = self._match_keywords(content_keywords, criteria)
-                    if not match_ok:
-                        continue
-                else:
-                    matched_kws = []
+                # Matched keywords (the keyword index already filtered the candidates)
+                matched_kws = self._matched_keywords(content.doc_id, compiled, keyword_postings)
 
                 # Content filter (skip if empty)
-                content_text = content.get("content", "")
-                if criteria.content and not self._match_text(content_text, criteria.content):
+                if compiled.content and not self._match_text(self.content_model.lowered(content, "content"), compiled.content):
                     continue
 
-                # Build result
-                results.append({
-                    "file_name": title,
-                    "page_number": content.get("page_number"),
-                    "page_abstract": content.get("abstract"),
-                    "page_content": content_text,
-                    "page_keywords": content_keywords,
-                    "published_by": publisher,
-                    "published_date": file_info.get("published_date"),
-                    "local_path": file_info.get("full_path", None),
-                    "download_url": file_info.get("download_url", None),
-                    "matched_keywords": matched_kws
-                })
-
-            # Sort results
-            if criteria.keywords:
-                # Sort by number of matched keywords (descending)
-                results = sorted(results, key=lambda x: len(x["matched_keywords"]), reverse=True)
-            else:
-                # Sort by published_date (descending)
-                results = sorted(results, key=lambda x: self._parse_date(x["published_date"]), reverse=True)
+                # Result dicts are only built for the requested page
+                matches.append((content, file_info, matched_kws, published))
+
+            # Sort key: number of matched keywords, else published_date (both descending)
+            sort_key = (lambda x: len(x[2])) if criteria.keywords else itemgetter(3)
 
             # Pagination
             page_size = self.max_results
-            total_matches = len(results)
+            total_matches = len(matches)
             total_pages = (total_matches + page_size - 1) // page_size
 
             # Validate page index against total pages
@@ -417,7 +407,11 @@ class ContentRetriever(BaseRetriever):
             # Slice results for the requested page
             start = (idx - 1) * page_size
             end = start + page_size
-            paginated_results = results[start:end]
+            file_locations = {}
+            paginated_results = [
+                self._build_result(content, file_info, matched_kws, file_locations)
+                for content, file_info, matched_kws, _ in self._sorted_page(matches, sort_key, start, end)
+            ]
 
             return {
                 "results": paginated_results,
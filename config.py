@@ -22,6 +22,12 @@ class Config:
     vlm_api_key = os.getenv("VLM_API_KEY", "")
     vlm_base_url = os.getenv("VLM_BASE_URL", "")
     vlm_model_name = os.getenv("VLM_MODEL_NAME", "")
+    # VLM 并发上限（自适应并发在 1 到该值之间调整）
+    vlm_max_concurrency = int(os.getenv("VLM_MAX_CONCURRENCY", "16"))
+
+    # VLM 响应缓存（按模型、提示词和页面图片内容寻址），默认位于项目目录下，由识别器在首次写入时创建
+    vlm_cache_dir = os.getenv("VLM_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vlm_cache"))
+    vlm_cache_ttl_days = int(os.getenv("VLM_CACHE_TTL_DAYS", "7"))
 
     llm_api_key = os.getenv("LLM_API_KEY", "")
     llm_base_url = os.getenv("LLM_BASE_URL", "")
@@ -30,6 +36,8 @@ class Config:
     eb_model_local_path = os.getenv("EMBEDDING_MODEL_LOCAL_PATH", "eb_model")
     eb_device = os.getenv("EMBEDDING_MODEL_DEVICE", "cpu").lower()
     faiss_index_dir = os.getenv("FAISS_INDEX_DIR", "faiss_index")
+    # 向量索引存储精度：fp16（默认）或 int8（内存再减半，需训练，相似度误差约 1e-3）
+    faiss_index_precision = os.getenv("FAISS_INDEX_PRECISION", "fp16").lower()
     os.makedirs(faiss_index_dir, exist_ok=True)
 
 config = Config()
@@ -1,11 +1,12 @@
 import os
 import threading
+import time
 from typing import Optional
 
 import numpy as np
 import faiss
+import torch
 from sentence_transformers import SentenceTransformer
-from tqdm import tqdm
 
 from logger import setup_logger
 from config import config
@@ -13,6 +14,43 @@ from models import ContentModel, FileModel
 
 logger = setup_logger(__name__)
 
+# Resolved once, local uploads always live here
+_LIBRARY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "library_files")
+
+class _QueryBatcher:
+    """Coalesce queries arriving from concurrent threads into a single batch call."""
+    def __init__(self, run_batch, window: float):
+        self._run_batch = run_batch  # Takes a list of requests, returns one result per request
+        self._window = window  # Seconds the first caller waits for others to join its batch
+        self._lock = threading.Lock()
+        self._pending = []  # [(request, outcome, done event)] waiting for the next batch
+
+    def submit(self, request):
+        outcome = {}
+        done = threading.Event()
+        with self._lock:
+            self._pending.append((request, outcome, done))
+            is_leader = len(self._pending) == 1
+        if is_leader:
+            # The first caller runs the batch for everyone who arrived within the window
+            time.sleep(self._window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+            try:
+                results = self._run_batch([item[0] for item in batch])
+                for (_, item_outcome, _), result in zip(batch, results):
+                    item_outcome["result"] = result
+            except Exception as e:
+                for _, item_outcome, _ in batch:
+                    item_outcome["error"] = e
+            finally:
+                for _, _, item_done in batch:
+                    item_done.set()
+        done.wait()
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
+
 class Embedder:
     """Singleton class for generating and managing text embeddings using SentenceTransformer."""
     _instance = None
@@ -20,6 +58,10 @@ class Embedder:
 
     EMBEDDING_DIM = 1024  # Default embedding dimension
     PAGE_IDS_FILE = "page_ids.npy"  # File name for storing page ID mapping
+    HNSW_M = 32  # Graph neighbours per node for the HNSW index
+    HNSW_EF_CONSTRUCTION = 40  # Candidate list size while building the graph
+    HNSW_EF_SEARCH = 16  # Minimum candidate list size while searching
+    QUERY_BATCH_WINDOW = 0.005  # Seconds to wait for concurrent queries to share one encode and search
 
     def __new__(cls):
         """Ensure singleton instance and initialize SentenceTransformer model."""
@@ -28,6 +70,16 @@ class Embedder:
                 if cls._instance is None:
                     instance = super(Embedder, cls).__new__(cls)
                     try:
+                        # Let CPU inference and FAISS search use every core
+                        cpu_count = os.cpu_count() or 1
+                        if (config.eb_device or "cpu") == "cpu":
+                            torch.set_num_threads(cpu_count)
+                            try:
+                                torch.set_num_interop_threads(2)
+                            except RuntimeError:
+                                pass  # Only settable before torch's first parallel work
+                        faiss.omp_set_num_threads(cpu_count)
+
                         # Load model from local path if provided, otherwise use default model
                         if config.eb_model_local_path:
                             instance.model = SentenceTransformer(
@@ -42,7 +94,17 @@ class Embedder:
                                 device=config.eb_device or "cpu"
                             )
                             logger.info("Downloaded and loaded Qwen3-Embedding-0.6B model")
+                        if (config.eb_device or "cpu").startswith("cuda"):
+                            # Half precision roughly halves GPU forward latency; outputs are re-normalized
+                            instance.model.half()
                         logger.info(f"Model running on device: {config.eb_device or 'cpu'}")
+                        # GPU resources for FAISS when the installed build can see a GPU
+                        instance.gpu_res = None
+                        if hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0:
+                            instance.gpu_res = faiss.StandardGpuResources()
+                            logger.info(f"FAISS search running on GPU ({faiss.get_num_gpus()} visible)")
+                        instance._index_cache = None  # (signature, index, page_ids) of the last loaded index
+                        instance._query_batcher = _QueryBatcher(instance._search_batch, cls.QUERY_BATCH_WINDOW)
                         cls._instance = instance
                     except Exception as e:
                         logger.error(f"Failed to load model: {str(e)}")
@@ -68,36 +130,37 @@ class Embedder:
 
             logger.info(f"Found {len(all_abstracts)} abstract records")
 
-            # Initialize FAISS index with inner product metric
-            index = faiss.IndexFlatIP(self.EMBEDDING_DIM)
-            page_ids = []
+            # Initialize FAISS index with inner product metric: exact on GPU (HNSW cannot be moved there,
+            # vectors are stored as FP16 when cloned), approximate (HNSW over FP16 or int8 vectors) on CPU
+            if self.gpu_res is not None:
+                index = faiss.IndexFlatIP(self.EMBEDDING_DIM)
+            else:
+                if config.faiss_index_precision == "int8":
+                    quantizer_type = faiss.ScalarQuantizer.QT_8bit
+                else:
+                    quantizer_type = faiss.ScalarQuantizer.QT_fp16
+                index = faiss.IndexHNSWSQ(
+                    self.EMBEDDING_DIM, quantizer_type, self.HNSW_M, faiss.METRIC_INNER_PRODUCT
+                )
+                index.hnsw.efConstruction = self.HNSW_EF_CONSTRUCTION
+            page_ids = [item['page_id'] for item in all_abstracts]
 
-            # Process content in batches
-            batch_size = 32
-            total_batches = (len(all_abstracts) + batch_size - 1) // batch_size
+            # Encode everything in one call so sentence-transformers can sort by length and pad per batch
+            batch_size = 64
             logger.info(f"Generating embeddings with batch size {batch_size}")
+            embeddings = self.model.encode(
+                [item['abstract'] for item in all_abstracts],
+                normalize_embeddings=True,
+                batch_size=batch_size,
+                convert_to_numpy=True,
+                show_progress_bar=True
+            )
 
-            for i in tqdm(
-                range(0, len(all_abstracts), batch_size),
-                total=total_batches,
-                desc="Generating embeddings",
-                unit="batch"
-            ):
-                batch = all_abstracts[i:i + batch_size]
-                texts = [item['abstract'] for item in batch]
-                batch_page_ids = [item['page_id'] for item in batch]
-
-                # Generate embeddings (calculation)
-                embeddings = self.model.encode(
-                    texts,
-                    normalize_embeddings=True,
-                    batch_size=batch_size,
-                    show_progress_bar=False
-                )
-
-                # Add embeddings to FAISS index
-                index.add(np.array(embeddings, dtype=np.float32))
-                page_ids.extend(batch_page_ids)
+            # Add embeddings to FAISS index
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            if not index.is_trained:
+                index.train(embeddings)
+            index.add(embeddings)
 
             # Save FAISS index and page ID mapping
             self._save_faiss_index(index, page_ids)
@@ -126,9 +189,7 @@ class Embedder:
         try:
             if not file_path or not isinstance(file_path, str):
                 return None
-            custom_root = os.path.dirname(os.path.abspath(__file__))
-            file_name = os.path.basename(file_path)
-            full_path = os.path.join(custom_root, "library_files", file_name)
+            full_path = os.path.join(_LIBRARY_DIR, os.path.basename(file_path))
             if os.path.isfile(full_path):
                 return os.path.normpath(full_path)
             return None
@@ -151,6 +212,9 @@ class Embedder:
             page_ids: List of page IDs corresponding to embeddings.
         """
         try:
+            # Drop the loaded index first, a live memory map would keep the page IDs file locked on Windows
+            self._index_cache = None
+
             # Save FAISS index
             index_path = os.path.join(config.faiss_index_dir, "faiss_index.index")
             faiss.write_index(index, index_path)
@@ -164,6 +228,70 @@ class Embedder:
             logger.error(f"Failed to save FAISS index or page IDs: {str(e)}")
             raise RuntimeError(f"Index saving failed: {str(e)}") from e
 
+    def _ensure_index(self):
+        """
+        Return the FAISS index and page ID mapping, reading them from disk only when the files changed.
+
+        Returns:
+            Tuple of (index, page_ids).
+        """
+        index_path = os.path.join(config.faiss_index_dir, "faiss_index.index")
+        ids_path = os.path.join(config.faiss_index_dir, self.PAGE_IDS_FILE)
+        try:
+            index_stat = os.stat(index_path)
+            ids_stat = os.stat(ids_path)
+        except FileNotFoundError:
+            logger.error(f"Missing index or page IDs file: {index_path}, {ids_path}")
+            raise FileNotFoundError("FAISS index or page IDs file not found")
+
+        signature = (index_stat.st_mtime_ns, index_stat.st_size, ids_stat.st_mtime_ns, ids_stat.st_size)
+        cached = self._index_cache
+        if cached is not None and cached[0] == signature:
+            return cached[1], cached[2]
+
+        index = faiss.read_index(index_path)
+        if self.gpu_res is not None and not hasattr(index, "hnsw"):
+            cloner_options = faiss.GpuClonerOptions()
+            cloner_options.useFloat16 = True
+            index = faiss.index_cpu_to_gpu(self.gpu_res, 0, index, cloner_options)
+        page_ids = np.load(ids_path, mmap_mode="r")  # Only the rows a query hits are paged in
+        self._index_cache = (signature, index, page_ids)
+        logger.info(f"Loaded FAISS index with {index.ntotal} vectors")
+        return index, page_ids
+
+    def _search_batch(self, requests: list) -> list:
+        """
+        Embed a batch of queries and search them in one FAISS call.
+
+        Args:
+            requests: List of (query input, search k) tuples.
+
+        Returns:
+            List of (similarities, indices, page_ids) tuples, one per request.
+        """
+        # Load FAISS index and page IDs
+        index, page_ids = self._ensure_index()
+
+        # Generate query embeddings
+        query_embeddings = self.model.encode(
+            [query_input for query_input, _ in requests],
+            normalize_embeddings=True,
+            batch_size=len(requests),
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+
+        search_k = max(request_k for _, request_k in requests)
+        if hasattr(index, "hnsw"):  # Flat indexes (GPU hosts, older builds) have no search breadth to tune
+            index.hnsw.efSearch = max(self.HNSW_EF_SEARCH, search_k)
+        distances, indices = index.search(
+            np.ascontiguousarray(query_embeddings, dtype=np.float32), search_k
+        )
+        return [
+            (distances[i, :request_k], indices[i, :request_k], page_ids)
+            for i, (_, request_k) in enumerate(requests)
+        ]
+
     def retrieve(
             self,
             query_text: str,
@@ -184,65 +312,39 @@ class Embedder:
             List of dictionaries with 'page_id' and 'similarity' for each result.
         """
         try:
-            # Load FAISS index and page IDs
-            index_path = os.path.join(config.faiss_index_dir, "faiss_index.index")
-            ids_path = os.path.join(config.faiss_index_dir, self.PAGE_IDS_FILE)
-            if not os.path.exists(index_path) or not os.path.exists(ids_path):
-                logger.error(f"Missing index or page IDs file: {index_path}, {ids_path}")
-                raise FileNotFoundError("FAISS index or page IDs file not found")
-
-            index = faiss.read_index(index_path)
-            page_ids = np.load(ids_path)
             file_model = FileModel()
             content_model = ContentModel()
 
             # Build query input
             query_input = f"Instruct: {instruction}\nQuery: {query_text}"
 
-            # Generate query embedding
-            query_embedding = self.model.encode(
-                [query_input],
-                normalize_embeddings=True,
-                batch_size=1,
-                show_progress_bar=False,
-            )
-
-            # Search for top-k similar results with a larger k to ensure threshold coverage
+            # Embed and search for top-k similar results, sharing the call with concurrent queries
             search_k = max(100, k)  # Search a larger k to cover threshold filtering
-            distances, indices = index.search(
-                np.array(query_embedding, dtype=np.float32), search_k
-            )
-
-            # Filter results based on recall threshold
-            filtered_results = []
-            for idx, sim in zip(indices[0], distances[0]):
-                if sim >= recall_threshold:
-                    page_id = str(page_ids[idx])
-                    filtered_results.append({"page_id": page_id, "similarity": float(sim)})
-                else:
-                    break
+            sims, indices, page_ids = self._query_batcher.submit((query_input, search_k))
 
-
-            if len(filtered_results) > k:
-                filtered_results = filtered_results[:k]
+            # Filter results based on recall threshold; hits come back sorted, so it is a single cut point
+            cutoff = min(int(np.searchsorted(-sims, -recall_threshold, side="right")), k)
+            hit_page_ids = page_ids[indices[:cutoff]].astype(str).tolist()
+            page_similarity = dict(zip(hit_page_ids, sims[:cutoff].tolist()))
 
             result = []
-            if filtered_results:
-                page_ids = [item["page_id"] for item in filtered_results]
-                file_ids = set()
-                page_id_to_item = {item["page_id"]: item for item in filtered_results}
-
-                contents = content_model.get_contents_by_page_ids(page_ids)
-
-                for content in contents:
-                    if content:
-                        file_ids.add(content["file_id"])
-                files = file_model.get_files_by_ids(list(file_ids))
-                file_map = {file["file_id"]: file for file in files if file}
+            if hit_page_ids:
+                # One batched lookup per table, contents come back in similarity order.
+                # This runs off the event loop, so hold the lock the retrievers read the indexes under.
+                with file_model.locked():
+                    contents = content_model.get_contents_by_page_ids(hit_page_ids)
+                    files = file_model.get_files_by_ids(list({content["file_id"] for content in contents}))
+                file_map = {file["file_id"]: file for file in files}
+
+                # Resolve each file's location once, not once per matching page
+                file_locations = {}
+                for file_id, file in file_map.items():
+                    if file.get("uploader") != "admin":
+                        file_locations[file_id] = (self._full_path(file.get("file_path")), None)
+                    else:
+                        file_locations[file_id] = (None, self._path2url(file.get("file_path")))
 
                 for content in contents:
-                    if not content:
-                        continue
                     page_id = content["page_id"]
                     file_id = content["file_id"]
                     file = file_map.get(file_id)
@@ -250,22 +352,18 @@ class Embedder:
                     if not file:
                         continue
 
-                    if file.get("uploader") != "admin":
-                        file["full_path"] = self._full_path(file.get("file_path"))
-                    else:
-                        file["download_url"] = self._path2url(file.get("file_path"))
-
+                    local_path, download_url = file_locations[file_id]
                     page_info = {
                         "page_number": content["page_number"],
                         "page_title": content["title"],
                         "page_abstract": content["abstract"],
                         "page_content": content["content"],
-                        "local_path": file.get("full_path", None),
-                        "download_url": file.get("download_url", None),
+                        "local_path": local_path,
+                        "download_url": download_url,
                         "file_name": file["file_name"],
                         "published_by": file["source"],
                         "published_date": file["published_date"],
-                        "vector_similarity": page_id_to_item[page_id]["similarity"]
+                        "vector_similarity": page_similarity[page_id]
                     }
                     result.append(page_info)
             return result
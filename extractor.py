@@ -1,8 +1,8 @@
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import io
-from typing import List
+from typing import Dict, List, Optional
 
 import fitz  # PyMuPDF
 from PIL import Image
@@ -14,6 +14,33 @@ from logger import setup_logger
 
 logger = setup_logger(__name__)
 
+# Fewest pages worth handing to a worker, below this a worker pool costs more than it saves
+PARALLEL_MIN_PAGES = 8
+
+def _render_pages(pdf_path: str, page_nums: List[int], output_dir: str, dpi: int, max_size: int) -> List[str]:
+    """Render a run of PDF pages to JPEG; top-level so it can run in a worker process"""
+    page_paths = []
+    doc = fitz.open(pdf_path)  # MuPDF documents can't be shared, each worker opens its own
+    try:
+        for page_num in page_nums:
+            page = doc.load_page(page_num)
+            # Render straight at the final size instead of rendering at full dpi and downsampling
+            zoom = min(dpi / 72, max_size / max(page.rect.width, page.rect.height))
+            # Opaque RGB explicitly, the buffer below is read as packed 3-byte pixels
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False, colorspace=fitz.csRGB)
+            # samples_mv is a view of MuPDF's buffer, samples would copy it into a bytes object first
+            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv)
+            # Guards against rounding past max_size by a pixel, a no-op otherwise, so a box filter is enough
+            img.thumbnail((max_size, max_size), Resampling.BOX)
+            img_path = os.path.join(output_dir, f"page_{page_num + 1}.jpg")
+            # No optimize pass: a second entropy-coding pass for a few percent smaller files
+            img.save(img_path, "JPEG", quality=90)
+            page_paths.append(img_path)
+            logger.debug(f"Processed page {page_num + 1} for {pdf_path}")
+    finally:
+        doc.close()
+    return page_paths
+
 class PDFExtractor:
     """PDF Extraction: Handles PDF file scanning, page extraction, and database updates"""
 
@@ -26,7 +53,7 @@ class PDFExtractor:
         self.files_dir = files_dir
         self.pages_dir = pages_dir
         self.file_model = FileModel()
-        self.file_cache = {}  # Cache for file MD5 and mtime
+        self.file_cache = {}  # Cache for file mtime and size
         logger.info(f"PDF extraction initialized | Files directory: {files_dir} | Pages directory: {pages_dir}")
 
     def run(self) -> None:
@@ -45,59 +72,59 @@ class PDFExtractor:
             return
         logger.info(f"Found {len(pdf_files)} PDF files")
 
-        # Preload file cache
+        # Preload file cache; a stat is enough here, files are only hashed once they look changed
         for pdf in pdf_files:
             file_path = os.path.join(self.files_dir, pdf)
             try:
-                file_hash = FileModel.calculate_md5(file_path)
-                last_modified = os.path.getmtime(file_path)
-                self.file_cache[file_path] = (file_hash, last_modified)
+                stat = os.stat(file_path)
+                self.file_cache[file_path] = (stat.st_mtime, stat.st_size)
             except Exception as e:
                 logger.error(f"Failed to cache file: {pdf} | Error: {e}")
 
         updates = []  # Batch updates
+        pending = []  # (pdf, file_id, file_hash, stat) of changed files, their pages are rendered together below
         for pdf in pdf_files:
             file_count += 1
             file_path = os.path.join(self.files_dir, pdf)
             try:
-                cached_hash, cached_mtime = self.file_cache.get(file_path, (None, None))
-                if cached_hash is None or self.file_model.is_file_changed(file_path):
+                cached_mtime, cached_size = self.file_cache.get(file_path, (None, None))
+                # Legacy records without a file_size get it backfilled with the batch update below
+                if cached_mtime is None or self.file_model.is_file_changed(file_path, size_backfill=updates):
                     logger.info(f"Detected changed file: {pdf}")
+                    # Hash and stat once, rendering reads the file but never changes it
+                    stat = os.stat(file_path)
+                    file_hash = FileModel.calculate_md5(file_path)
 
-                    # Get or create file record
-                    file_record = self.file_model.get_file_by_path(file_path)
-                    if not file_record:
-                        file_hash = FileModel.calculate_md5(file_path)
-                        last_modified = os.path.getmtime(file_path)
-                        self.file_model.create_file(
-                            file_path,
-                            pdf,
-                            file_hash,
-                            last_modified,
-                            opt_msg="initial",
-                        )
+                    # Record creation and status transitions land in a single DB file rewrite
+                    with self.file_model.deferred_writes():
+                        # Get or create file record
                         file_record = self.file_model.get_file_by_path(file_path)
-                        if file_record is None:
-                            logger.error(f"Failed to retrieve file record for {file_path}, skipping")
-                            continue
-                        updates.append((file_record["file_id"], {
-                            "file_hash": file_hash,
-                            "last_modified": last_modified,
-                            "opt_msg": "pending_processing"
-                        }))
-
-                    # Process file using file_id
-                    self.process_file(file_record["file_id"])
-                    processed_count += 1
-
-                    # Prepare update after processing
-                    current_hash = FileModel.calculate_md5(file_path)
-                    current_mtime = os.path.getmtime(file_path)
-                    updates.append((file_record["file_id"], {
-                        "file_hash": current_hash,
-                        "last_modified": current_mtime,
-                        "opt_msg": "processed"
-                    }))
+                        if not file_record:
+                            # mtime/size are only stored with the "processed" update, so a run that dies
+                            # before then leaves the file looking changed and it is picked up again
+                            self.file_model.create_file(
+                                file_path,
+                                pdf,
+                                file_hash,
+                                0.0,
+                                opt_msg="initial",
+                            )
+                            file_record = self.file_model.get_file_by_path(file_path)
+                            if file_record is None:
+                                logger.error(f"Failed to retrieve file record for {file_path}, skipping")
+                                continue
+                            updates.append((file_record["file_id"], {
+                                "file_hash": file_hash,
+                                "opt_msg": "pending_processing"
+                            }))
+
+                        # Reset status and old pages before rendering
+                        prepared_path = self._prepare_file(file_record["file_id"])
+                    if prepared_path is None:
+                        # Preparation failed and was recorded, don't render or mark it processed
+                        error_count += 1
+                        continue
+                    pending.append((pdf, file_record["file_id"], file_hash, stat))
                 else:
                     pass
             except Exception as e:
@@ -105,20 +132,49 @@ class PDFExtractor:
                 logger.error(f"Failed to process file: {pdf} | Error: {e}")
                 logger.error(f"Detailed error for file: {pdf}", exc_info=True)
 
-        # Batch update file records
-        for file_id, update_data in updates:
-            self.file_model.update_file(file_id, **update_data)
+        # Render every changed PDF through one worker pool, so small files render side by side
+        rendered = self._render_pdfs([os.path.join(self.files_dir, pdf) for pdf, *_ in pending], self.pages_dir)
+        for pdf, file_id, file_hash, stat in pending:
+            file_path = os.path.join(self.files_dir, pdf)
+            try:
+                # Page records and the final status land in a single DB file rewrite
+                with self.file_model.deferred_writes():
+                    self._finish_file(file_id, rendered.get(file_path, []))
+                processed_count += 1
+
+                # Prepare update after processing
+                updates.append((file_id, {
+                    "file_hash": file_hash,
+                    "last_modified": stat.st_mtime,
+                    "file_size": stat.st_size,
+                    "opt_msg": "processed"
+                }))
+            except Exception as e:
+                error_count += 1
+                logger.error(f"Failed to process file: {pdf} | Error: {e}")
+                logger.error(f"Detailed error for file: {pdf}", exc_info=True)
+
+        # Batch update file records in a single write
+        if updates:
+            self.file_model.update_files(updates)
 
         logger.info(f"Scan completed | Total files: {file_count} | Processed: {processed_count} | Failed: {error_count}")
 
     def process_file(self, file_id: str) -> None:
         """Process a single PDF file using file_id"""
+        file_path = self._prepare_file(file_id)
+        if file_path:
+            # Process PDF file with parallel rendering
+            self._finish_file(file_id, self._pdf_to_pages(file_path, self.pages_dir))
+
+    def _prepare_file(self, file_id: str) -> Optional[str]:
+        """Mark a file as updating and clear its old pages, returns its path or None on failure"""
         try:
             # Retrieve file record by file_id
             file_record = self.file_model.get_file_by_id(file_id)
             if not file_record:
                 logger.error(f"File record not found: file_id={file_id}")
-                return
+                return None
 
             file_path = file_record["file_path"]
             file_name = os.path.basename(file_path)
@@ -131,39 +187,55 @@ class PDFExtractor:
 
             # Perform cleanup
             self._cleanup_invalid_pages(file_id, page_subdir)
+            return file_path
 
-            # Process PDF file with parallel rendering
-            pages_paths = self._pdf_to_pages(file_path, self.pages_dir)
+        except Exception as e:
+            self._handle_failure(file_id, e)
+            return None
+
+    def _finish_file(self, file_id: str, pages_paths: List[str]) -> None:
+        """Store the rendered pages of a prepared file and mark it completed"""
+        try:
+            file_record = self.file_model.get_file_by_id(file_id)
+            if not file_record:
+                logger.error(f"File record not found: file_id={file_id}")
+                return
+            file_name = os.path.basename(file_record["file_path"])
 
-            # Add page records
+            # Add page records, streamed straight into the stored page list
             success_count = 0
-            page_data_list = []
-            for i, img_path in enumerate(pages_paths):
-                page_data_list.append({
+            page_data = (
+                {
                     "page_number": i + 1,
                     "page_path": img_path,
                     "abstract": None,
                     "keywords": [],
                     "is_aigc": False,
                     "processed_at": datetime.now().isoformat()
-                })
+                }
+                for i, img_path in enumerate(pages_paths)
+            )
 
-            if self.file_model.add_pages(file_id, page_data_list):
-                success_count = len(page_data_list)
+            if self.file_model.add_pages(file_id, page_data):
+                success_count = len(pages_paths)
 
             self._update_status(file_id, "completed")
             logger.info(f"Processing completed | File: {file_name} | Pages: {success_count}/{len(pages_paths)}")
 
         except Exception as e:
-            current_file = self.file_model.get_file_by_id(file_id) or {}
-            opt_status = current_file.get("opt_msg", "unknown")
-            file_name = current_file.get("file_name", "unknown")
-            if opt_status == "pages_updating":
-                logger.error(f"Critical error: File {file_name} cleanup done but update incomplete!")
-                self._update_status(file_id, "needs_recovery")
-            else:
-                logger.error(f"Failed to process file: {file_name} | Stage: {opt_status} | Error: {e}")
-            logger.error(f"Detailed error for file processing", exc_info=True)
+            self._handle_failure(file_id, e)
+
+    def _handle_failure(self, file_id: str, error: Exception) -> None:
+        """Log a processing failure and flag files left half updated for recovery"""
+        current_file = self.file_model.get_file_by_id(file_id) or {}
+        opt_status = current_file.get("opt_msg", "unknown")
+        file_name = current_file.get("file_name", "unknown")
+        if opt_status == "pages_updating":
+            logger.error(f"Critical error: File {file_name} cleanup done but update incomplete!")
+            self._update_status(file_id, "needs_recovery")
+        else:
+            logger.error(f"Failed to process file: {file_name} | Stage: {opt_status} | Error: {error}")
+        logger.error(f"Detailed error for file processing", exc_info=True)
 
     def _cleanup_invalid_pages(self, file_id: str, page_dir: str) -> None:
         """Cleanup invalid data (database records and image files)"""
@@ -195,45 +267,86 @@ class PDFExtractor:
         Args:
             pdf_path: Path to the PDF file
             output_dir: Output directory
-            dpi: Rendering resolution (default 200)
+            dpi: Maximum rendering resolution (default 200)
             max_size: Maximum image size (default 1600px)
 
         Returns:
             List of generated image paths
         """
-        # Create subdirectory based on filename
-        pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
-        pdf_output_dir = os.path.join(output_dir, pdf_name)
-        os.makedirs(pdf_output_dir, exist_ok=True)
+        return PDFExtractor._render_pdfs([pdf_path], output_dir, dpi, max_size)[pdf_path]
 
-        page_paths = []
-        doc = None
+    @staticmethod
+    def _render_pdfs(
+            pdf_paths: List[str],
+            output_dir: str,
+            dpi: int = 200,
+            max_size: int = 1600
+    ) -> Dict[str, List[str]]:
+        """
+        Convert the pages of several PDFs to optimized JPEG images through one shared worker pool
 
+        Args:
+            pdf_paths: Paths to the PDF files
+            output_dir: Output directory
+            dpi: Maximum rendering resolution (default 200)
+            max_size: Maximum image size (default 1600px)
+
+        Returns:
+            Generated image paths per PDF path, empty for PDFs that failed to convert
+        """
+        page_paths = {pdf_path: [] for pdf_path in pdf_paths}
+        output_dirs = {}
+        errors = {}
+        jobs = []  # (pdf_path, page run), each PDF's runs contiguous and in page order
+        for pdf_path in pdf_paths:
+            # Create subdirectory based on filename
+            pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+            output_dirs[pdf_path] = os.path.join(output_dir, pdf_name)
+            try:
+                os.makedirs(output_dirs[pdf_path], exist_ok=True)
+                logger.info(f"Starting PDF conversion: {os.path.basename(pdf_path)}")
+                with fitz.open(pdf_path) as doc:
+                    total_pages = len(doc)
+            except Exception as e:
+                errors[pdf_path] = e
+                continue
+            # Long PDFs are split into one run per core, each at least PARALLEL_MIN_PAGES pages
+            runs = max(1, min(os.cpu_count() or 1, total_pages // PARALLEL_MIN_PAGES))
+            chunk = max(1, -(-total_pages // runs))
+            jobs.extend((pdf_path, list(range(start, min(start + chunk, total_pages))))
+                        for start in range(0, total_pages, chunk))
+
+        total_pages = sum(len(run) for _, run in jobs)
+        workers = min(os.cpu_count() or 1, len(jobs), total_pages // PARALLEL_MIN_PAGES)
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
         try:
-            logger.info(f"Starting PDF conversion: {os.path.basename(pdf_path)}")
-            doc = fitz.open(pdf_path)
-            total_pages = len(doc)
-
-            # Sequential processing
-            for page_num in range(total_pages):
-                page = doc.load_page(page_num)
-                pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
-                img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
-                img.thumbnail((max_size, max_size), Resampling.LANCZOS)
-                img_buffer = io.BytesIO()
-                img.save(img_buffer, "JPEG", quality=90, optimize=True)
-                img_path = os.path.join(pdf_output_dir, f"page_{page_num + 1}.jpg")
-                with open(img_path, "wb") as f:
-                    f.write(img_buffer.getvalue())
-                page_paths.append(img_path)
-                logger.debug(f"Processed page {page_num + 1} for {pdf_path}")
-
-            logger.info(f"Conversion completed | Total pages: {total_pages} | Output directory: {pdf_output_dir}")
-            return page_paths
+            if executor:
+                # Parallel processing, results collected in submission order
+                futures = [executor.submit(_render_pages, pdf_path, run, output_dirs[pdf_path], dpi, max_size)
+                           for pdf_path, run in jobs]
+            for i, (pdf_path, run) in enumerate(jobs):
+                if pdf_path in errors:
+                    continue
+                try:
+                    if executor:
+                        page_paths[pdf_path].extend(futures[i].result())
+                    else:
+                        # Sequential processing
+                        page_paths[pdf_path].extend(_render_pages(pdf_path, run, output_dirs[pdf_path], dpi, max_size))
+                except Exception as e:
+                    errors[pdf_path] = e
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
 
-        except Exception as e:
-            logger.error(f"Failed to convert PDF: {os.path.basename(pdf_path)} | Error: {e}")
-            if page_paths:
+        for pdf_path in pdf_paths:
+            pdf_output_dir = output_dirs[pdf_path]
+            if pdf_path not in errors:
+                logger.info(f"Conversion completed | Total pages: {len(page_paths[pdf_path])} | Output directory: {pdf_output_dir}")
+                continue
+
+            logger.error(f"Failed to convert PDF: {os.path.basename(pdf_path)} | Error: {errors[pdf_path]}")
+            if page_paths[pdf_path] or (os.path.isdir(pdf_output_dir) and os.listdir(pdf_output_dir)):
                 try:
                     shutil.rmtree(pdf_output_dir)
                     logger.info(f"Cleaned up failed conversion directory: {pdf_output_dir}")
@@ -241,11 +354,8 @@ class PDFExtractor:
                     logger.error(f"Failed to cleanup conversion directory: {pdf_output_dir} | Error: {cleanup_error}")
                 except Exception as unexpected_error:
                     logger.error(f"Unexpected error during cleanup: {unexpected_error}", exc_info=True)
-            return []
-        finally:
-            if doc:
-                doc.close()
-
+            page_paths[pdf_path] = []
+        return page_paths
 
 # async def main():
 #     import time
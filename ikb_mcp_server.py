@@ -1,3 +1,4 @@
+import asyncio
 from typing import Optional, List
 from datetime import datetime
 
@@ -8,6 +9,30 @@ from embedder import Embedder
 
 mcp = FastMCP("Insights Knowledge Base")
 
+# Retrievers hold no per-query state, one of each serves every call
+_file_retriever = FileRetriever()
+_content_retriever = ContentRetriever()
+# Embedder loads its model on first use, built once off the event loop
+_embedder: Optional[Embedder] = None
+_embedder_lock = asyncio.Lock()
+
+async def _get_embedder() -> Embedder:
+    global _embedder
+    if _embedder is None:
+        async with _embedder_lock:
+            if _embedder is None:
+                _embedder = await asyncio.to_thread(Embedder)
+    return _embedder
+
+def _normalize_keywords(keywords: Optional[List[str]]) -> List[str]:
+    # Drop blank and case-insensitive duplicate keywords once per call, keeping the first spelling
+    unique = {}
+    for keyword in keywords or []:
+        key = keyword.strip().lower() if keyword else ""
+        if key and key not in unique:
+            unique[key] = keyword
+    return list(unique.values())
+
 @mcp.tool()
 async def search_report_profile(
         keywords: List[str] = None,
@@ -54,7 +79,7 @@ async def search_report_profile(
 
     LLM需将该方法返回结果组织成通畅的语言传达给用户。
     """
-    keywords = [] if not keywords else keywords
+    keywords = _normalize_keywords(keywords)
     criteria = SearchCriteria(
         keywords=keywords,
         title=title,
@@ -65,8 +90,7 @@ async def search_report_profile(
         match_logic=match_logic, # type: ignore
     )
 
-    retriever = FileRetriever()
-    result = retriever.run(criteria, page_index)
+    result = _file_retriever.run(criteria, page_index)
     return result
 
 @mcp.tool()
@@ -117,7 +141,7 @@ async def search_content_detail(
 
     LLM需将该方法返回结果组织成通畅的语言传达给用户。
     """
-    keywords = [] if not keywords else keywords
+    keywords = _normalize_keywords(keywords)
     criteria = SearchCriteria(
         keywords=keywords,
         title=title,
@@ -128,8 +152,7 @@ async def search_content_detail(
         match_logic=match_logic, # type: ignore
 
     )
-    retriever = ContentRetriever()
-    result = retriever.run(criteria, page_index)
+    result = _content_retriever.run(criteria, page_index)
     return result
 
 @mcp.tool()
@@ -157,8 +180,9 @@ async def get_similar_content_by_rag(user_query: str):
 
     LLM需将该方法返回结果组织成通畅的语言传达给用户。
     """
-    embedding_model = Embedder()
-    result = embedding_model.retrieve(user_query)
+    embedding_model = await _get_embedder()
+    # Off the event loop, so concurrent calls can share one embedding batch
+    result = await asyncio.to_thread(embedding_model.retrieve, user_query)
     return result
 
 if __name__ == "__main__":
@@ -1,6 +1,11 @@
+import atexit
 import logging
+import multiprocessing
+import os
+import queue
 import sys
-from logging.handlers import RotatingFileHandler
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 # 在模块层定义自定义日志级别常量
 SUCCESS_LEVEL = 25
@@ -10,13 +15,16 @@ logging.addLevelName(SUCCESS_LEVEL, 'SUCCESS')
 class UTF8StreamHandler(logging.StreamHandler):
     """支持 UTF-8 编码的控制台日志处理器"""
 
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self._terminator_bytes = self.terminator.encode('utf-8')  # 换行符只编码一次
+
     def emit(self, record):
         try:
             msg = self.format(record)
-            # 确保使用 UTF-8 编码写入控制台
+            # 确保使用 UTF-8 编码写入控制台，消息和换行符合并为一次写入
             stream = self.stream
-            stream.buffer.write(msg.encode('utf-8'))
-            stream.buffer.write(self.terminator.encode('utf-8'))
+            stream.buffer.write(msg.encode('utf-8') + self._terminator_bytes)
             self.flush()
         except Exception as e:
             # 处理错误时避免递归
@@ -24,6 +32,94 @@ class UTF8StreamHandler(logging.StreamHandler):
             self.handleError(record)
 
 
+class _ForkSafeQueueHandler(QueueHandler):
+    """把日志记录放入队列，由后台线程格式化并写入；fork 出的子进程中后台线程不存在，改为同步写入"""
+
+    def __init__(self, listener):
+        super().__init__(listener.queue)
+        self._listener = listener
+        self._pid = os.getpid()
+        self._child_pid = None
+        self._child_handlers = []
+
+    def _handlers_for_child(self):
+        # 子进程不能使用继承来的轮转文件处理器（会与父进程同时轮转同一文件），改用只追加、不轮转的文件处理器
+        if self._child_pid != os.getpid():
+            handlers = []
+            for handler in self._listener.handlers:
+                if isinstance(handler, RotatingFileHandler):
+                    file_handler = logging.FileHandler(handler.baseFilename, encoding='utf-8', delay=True)
+                    file_handler.setLevel(handler.level)
+                    file_handler.setFormatter(handler.formatter)
+                    handler = file_handler
+                handlers.append(handler)
+            self._child_handlers = handlers
+            self._child_pid = os.getpid()
+        return self._child_handlers
+
+    def emit(self, record):
+        if os.getpid() != self._pid:
+            try:
+                record = self.prepare(record)
+                for handler in self._handlers_for_child():
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            except Exception:
+                self.handleError(record)
+            return
+        super().emit(record)
+
+
+_handlers_lock = threading.Lock()
+_file_handler = None  # 所有模块共用一个文件处理器，避免多个处理器各自轮转同一个文件
+_queue_handlers = {}  # {use_emoji: 队列处理器}，控制台格式相同的 logger 共用一个队列和后台线程
+
+
+def _get_queue_handler(use_emoji):
+    global _file_handler
+    with _handlers_lock:
+        queue_handler = _queue_handlers.get(use_emoji)
+        if queue_handler is not None:
+            return queue_handler
+
+        # 创建支持 UTF-8 的控制台处理器
+        console_handler = UTF8StreamHandler(sys.stdout)
+        console_handler.setLevel(logging.INFO)
+
+        # 设置控制台格式（保留原有格式选项）
+        console_format = (
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+            if use_emoji
+            else '[%(levelname)s] %(name)s: %(message)s'
+        )
+        console_handler.setFormatter(logging.Formatter(console_format))
+
+        # 文件处理器（不需要修改，默认使用 UTF-8）
+        if _file_handler is None:
+            # spawn/forkserver 启动的工作进程会重新导入本模块：只追加不轮转，轮转只由主进程负责
+            # （子进程导入主模块时 parent_process() 尚未设置，进程名则已是工作进程名）
+            if multiprocessing.current_process().name != 'MainProcess':
+                _file_handler = logging.FileHandler('application.log', encoding='utf-8', delay=True)
+            else:
+                _file_handler = RotatingFileHandler(
+                    'application.log',
+                    maxBytes=5 * 1024 * 1024,
+                    backupCount=3,
+                    encoding='utf-8'  # 确保文件也使用 UTF-8
+                )
+            _file_handler.setLevel(logging.DEBUG)
+            _file_handler.setFormatter(logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+            ))
+
+        # 格式化和写入交给后台线程，调用方（包括事件循环）只需入队
+        listener = QueueListener(queue.Queue(-1), console_handler, _file_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)  # 退出时写完队列中剩余的日志
+        queue_handler = _queue_handlers[use_emoji] = _ForkSafeQueueHandler(listener)
+        return queue_handler
+
+
 def setup_logger(name, use_emoji=False):
     logger = logging.getLogger(name)
     if hasattr(logger, 'success'):  # 防止重复初始化
@@ -31,36 +127,11 @@ def setup_logger(name, use_emoji=False):
 
     logger.setLevel(logging.DEBUG)
 
-    # 创建支持 UTF-8 的控制台处理器
-    console_handler = UTF8StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
-
-    # 设置控制台格式（保留原有格式选项）
-    console_format = (
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        if use_emoji
-        else '[%(levelname)s] %(name)s: %(message)s'
-    )
-    console_handler.setFormatter(logging.Formatter(console_format))
-
-    # 文件处理器（不需要修改，默认使用 UTF-8）
-    file_handler = RotatingFileHandler(
-        'application.log',
-        maxBytes=5 * 1024 * 1024,
-        backupCount=3,
-        encoding='utf-8'  # 确保文件也使用 UTF-8
-    )
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    ))
-
     # 移除可能存在的默认处理器
     if logger.hasHandlers():
         logger.handlers.clear()
 
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    logger.addHandler(_get_queue_handler(use_emoji))
 
     # 添加自定义 success 方法
     def success(msg, *args, **kwargs):
@@ -1,32 +1,137 @@
 import os
+import copy
 import hashlib
-from datetime import datetime
-from typing import Any, Dict, Optional, List
+import bisect
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Optional, List
 
 import uuid
-from tinydb import TinyDB, Query
+from tinydb import TinyDB
+from tinydb.middlewares import Middleware
+from tinydb.table import Document
+from tinydb.storages import JSONStorage
 from config import config
 
+try:
+    # Optional: orjson (de)serializes the whole database several times faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
+
 from logger import setup_logger
 
 logger = setup_logger(__name__)
 
+class DeferredWriteMiddleware(Middleware):
+    """Storage middleware that can hold writes in memory and flush them to disk in one go."""
+    def __init__(self, storage_cls):
+        super().__init__(storage_cls)
+        self.deferred = False
+        self.cache = None
+        self.dirty = False
+
+    def read(self):
+        if not self.deferred:
+            return self.storage.read()
+        if self.cache is None:
+            self.cache = self.storage.read()
+        return self.cache
+
+    def write(self, data):
+        if not self.deferred:
+            self.storage.write(data)
+            return
+        self.cache = data
+        self.dirty = True
+
+    def flush(self) -> None:
+        if self.dirty:
+            self.storage.write(self.cache)
+        self.cache = None
+        self.dirty = False
+
+class OrjsonStorage(JSONStorage):
+    """JSON file storage that reads and writes through orjson, falling back to the json module."""
+    def __init__(self, path: str, **kwargs):
+        super().__init__(path, access_mode='rb+' if orjson else 'r+', **kwargs)
+
+    def read(self):
+        if orjson is None:
+            return super().read()
+        self._handle.seek(0)
+        raw = self._handle.read()
+        return orjson.loads(raw) if raw else None
+
+    def write(self, data):
+        if orjson is None:
+            super().write(data)
+            return
+        self._handle.seek(0)
+        self._handle.write(orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS))
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self._handle.truncate()
+
+class _PendingSnapshot(dict):
+    """Snapshot built inside deferred_writes(), where documents share nested lists with the pending data.
+
+    Each document is deep-copied the first time it is read, so only the records callers actually
+    touch are copied and mutating one can't change what is about to be flushed.
+    """
+    def __init__(self, docs):
+        super().__init__((doc.doc_id, doc) for doc in docs)
+        self._shared = set(self)  # doc_ids not copied yet
+
+    def __getitem__(self, doc_id):
+        doc = super().__getitem__(doc_id)
+        if doc_id in self._shared:
+            doc = Document(copy.deepcopy(dict(doc)), doc_id)
+            super().__setitem__(doc_id, doc)
+            self._shared.discard(doc_id)
+        return doc
+
+    def get(self, doc_id, default=None):
+        return self[doc_id] if doc_id in self else default
+
+    def values(self):
+        return (self[doc_id] for doc_id in self)
+
+    def items(self):
+        return ((doc_id, self[doc_id]) for doc_id in self)
+
 class TinyDBManager:
     """Manage TinyDB instance as a singleton with indexes."""
     _instance = None
-    _file_index = {}  # Index for files: {file_id: doc_id, file_path: doc_id}
-    _content_index = {}  # Index for contents: {page_id: doc_id, file_id: set(doc_ids)}
+    _lock = threading.Lock()
+    _access_lock = threading.RLock()  # Serializes index/snapshot reads against rebuilds from other threads
+    _file_id_index = {}  # Index for files: {file_id: doc_id}
+    _file_path_index = {}  # Index for files: {normalized file_path: doc_id}
+    _page_id_index = {}  # Index for contents: {page_id: doc_id}
+    _file_contents_index = {}  # Index for contents: {file_id: set(doc_ids)}
+    _tag_index = {}  # Inverted index for file tags: {normalized tag: set(doc_ids)}
+    _publisher_index = {}  # Index for file sources: {normalized source: set(doc_ids)}
+    _keyword_index = {}  # Inverted index for content keywords: {normalized keyword: set(doc_ids)}
+    _snapshots = {}  # In-memory table snapshots for read paths: {table_name: {doc_id: document}}
+    _lowered = {}  # Lowercased text fields of snapshot documents: {table_name: {(doc_id, field): text}}
+    _date_order = None  # Files snapshot sorted by published day: (days, doc_ids), rebuilt after a write
+    _db_signature = None  # (mtime_ns, size) of the DB file as last seen by this process
 
     def __new__(cls):
         if cls._instance is None:
-            os.makedirs(os.path.dirname(config.DB_TEST_PATH), exist_ok=True)
-            cls._instance = super().__new__(cls)
-            try:
-                cls._instance.db = TinyDB(config.DB_TEST_PATH)
-                cls._build_indexes()
-            except Exception as e:
-                logger.error(f"Database initialization failed: {e}")
-                raise RuntimeError(f"Database initialization failed: {e}") from e
+            with cls._lock:
+                if cls._instance is None:
+                    os.makedirs(os.path.dirname(config.DB_TEST_PATH), exist_ok=True)
+                    cls._instance = super().__new__(cls)
+                    try:
+                        cls._instance.db = TinyDB(config.DB_TEST_PATH, storage=DeferredWriteMiddleware(OrjsonStorage))
+                        cls._build_indexes()
+                        cls._db_signature = cls._stat_db()
+                    except Exception as e:
+                        logger.error(f"Database initialization failed: {e}")
+                        raise RuntimeError(f"Database initialization failed: {e}") from e
         return cls._instance
 
     @classmethod
@@ -39,22 +144,159 @@ class TinyDBManager:
         # Build file index
         for doc in files_table.all():
             doc_id = doc.doc_id
-            cls._file_index[doc['file_id']] = doc_id
-            cls._file_index[os.path.normpath(doc['file_path'])] = doc_id
+            cls._file_id_index[doc['file_id']] = doc_id
+            cls._file_path_index[os.path.normpath(doc['file_path'])] = doc_id
+            cls._index_terms(cls._tag_index, doc_id, doc.get('tags'))
+            cls._index_terms(cls._publisher_index, doc_id, [doc.get('source')])
 
         # Build content index
         for doc in contents_table.all():
             doc_id = doc.doc_id
-            cls._content_index[doc['page_id']] = doc_id
-            cls._content_index.setdefault(doc['file_id'], set()).add(doc_id)
+            cls._page_id_index[doc['page_id']] = doc_id
+            cls._file_contents_index.setdefault(doc['file_id'], set()).add(doc_id)
+            cls._index_terms(cls._keyword_index, doc_id, doc.get('keywords'))
+
+    @staticmethod
+    def _stat_db() -> Optional[tuple]:
+        try:
+            st = os.stat(config.DB_TEST_PATH)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    @classmethod
+    def sync_with_disk(cls) -> None:
+        """Rebuild indexes and drop snapshots if another process changed the DB file."""
+        with cls._access_lock:
+            signature = cls._stat_db()
+            if signature == cls._db_signature:
+                return
+            logger.info("Database file changed on disk, rebuilding indexes")
+            for index in (cls._file_id_index, cls._file_path_index, cls._page_id_index, cls._file_contents_index,
+                          cls._tag_index, cls._publisher_index, cls._keyword_index):
+                index.clear()
+            cls._snapshots.clear()
+            cls._lowered.clear()
+            cls._date_order = None
+            cls._build_indexes()
+            cls._db_signature = signature
+
+    @classmethod
+    def get_snapshot(cls, table_name: str) -> Dict[int, Dict]:
+        """Return a cached {doc_id: document} view of a table, loaded on first use after a write.
+
+        Documents are shared between callers and must be treated as read-only. Inside deferred_writes()
+        the storage hands out its pending data, so documents are deep-copied as they are read there;
+        otherwise a caller mutating a nested list (pages, tags, ...) would silently change the flush.
+        """
+        with cls._access_lock:
+            cls.sync_with_disk()
+            snapshot = cls._snapshots.get(table_name)
+            if snapshot is None:
+                docs = cls._instance.db.table(table_name).all()
+                if cls._instance.db.storage.deferred:
+                    snapshot = _PendingSnapshot(docs)
+                else:
+                    snapshot = {doc.doc_id: doc for doc in docs}
+                cls._snapshots[table_name] = snapshot
+            return snapshot
+
+    @classmethod
+    def lowered_field(cls, table_name: str, doc: Dict, field: str) -> str:
+        """Return a snapshot document's text field lowercased, computed once per snapshot."""
+        with cls._access_lock:
+            cache = cls._lowered.setdefault(table_name, {})
+            key = (doc.doc_id, field)  # type: ignore
+            value = cache.get(key)
+            if value is None:
+                value = cache[key] = doc.get(field, "").lower()
+            return value
+
+    @classmethod
+    def invalidate(cls, table_name: str) -> None:
+        """Drop a table snapshot after a write made through the models."""
+        with cls._access_lock:
+            cls._snapshots.pop(table_name, None)
+            cls._lowered.pop(table_name, None)
+            if table_name == 'files':
+                cls._date_order = None
+            cls._db_signature = cls._stat_db()
+
+    @classmethod
+    @contextmanager
+    def deferred_writes(cls):
+        """Buffer all writes made inside the block and rewrite the DB file once on exit (nestable)."""
+        storage = cls._instance.db.storage
+        if storage.deferred:
+            yield
+            return
+        storage.deferred = True
+        try:
+            yield
+        finally:
+            storage.deferred = False
+            try:
+                storage.flush()
+            finally:
+                # Our own flush is not an external change, don't trigger an index rebuild
+                cls._db_signature = cls._stat_db()
+
+    @staticmethod
+    def normalize_term(term: str) -> str:
+        """Normalize a tag/keyword for index lookups: stripped and case-insensitive."""
+        return term.strip().lower()
+
+    @classmethod
+    def _index_terms(cls, index: Dict, doc_id: int, terms: Optional[List[str]]) -> None:
+        """Add doc_id to the posting set of every term."""
+        for term in terms or []:
+            if term:
+                index.setdefault(cls.normalize_term(term), set()).add(doc_id)
+
+    @classmethod
+    def _unindex_terms(cls, index: Dict, doc_id: int, terms: Optional[List[str]]) -> None:
+        """Remove doc_id from the posting set of every term."""
+        for term in terms or []:
+            if not term:
+                continue
+            key = cls.normalize_term(term)
+            postings = index.get(key)
+            if postings is not None:
+                postings.discard(doc_id)
+                if not postings:
+                    index.pop(key)
+
+    @classmethod
+    def term_postings(cls, index: Dict, terms: List[str]) -> List[set]:
+        """Return the posting set of each term, aligned with terms (read-only)."""
+        cls.sync_with_disk()
+        return [index.get(cls.normalize_term(term), set()) for term in terms]
+
+    @classmethod
+    def lookup_terms(cls, index: Dict, terms: List[str], match_all: bool = False) -> set:
+        """Return doc_ids containing any (or, with match_all, every) of the terms."""
+        postings = cls.term_postings(index, terms)
+        if not postings:
+            return set()
+        if match_all:
+            return set.intersection(*postings)
+        return set().union(*postings)
 
 class FileModel:
     """Model for file metadata storage."""
+
     def __init__(self):
         self.manager = TinyDBManager()
         self.db = self.manager.db
         self.files = self.db.table('files')
-        self.query = Query()
+
+    def deferred_writes(self):
+        """Context manager batching the writes inside it into a single DB file rewrite."""
+        return self.manager.deferred_writes()
+
+    def locked(self):
+        """Lock to hold while reading indexes/snapshots, so a rebuild from another thread can't interleave."""
+        return self.manager._access_lock
 
     def get_file_by_path(self, file_path: str) -> Optional[Dict]:
         """Retrieve file record by file path using index."""
@@ -62,7 +304,7 @@ class FileModel:
         try:
             # Normalize file path for consistency
             normalized_path = os.path.normpath(file_path)
-            doc_id = self.manager._file_index.get(normalized_path)
+            doc_id = self.manager._file_path_index.get(normalized_path)
             if doc_id is None:
                 logger.warning(f"File record not found: {normalized_path}")
                 return None
@@ -78,7 +320,7 @@ class FileModel:
     def get_file_by_id(self, file_id: str) -> Optional[Dict]:
         """Retrieve file record by file ID using index."""
         try:
-            doc_id = self.manager._file_index.get(file_id)
+            doc_id = self.manager._file_id_index.get(file_id)
             if doc_id is None:
                 logger.warning(f"File record not found: {file_id}")
                 return None
@@ -98,7 +340,8 @@ class FileModel:
             uploader: str = "",
             language: str = "zh",
             topic: str = "",
-            published_date: str = ""
+            published_date: str = "",
+            file_size: Optional[int] = None
     ) -> int:
         """Create a new file record and update index."""
         # Normalize file path for consistency
@@ -123,14 +366,17 @@ class FileModel:
             "uploader": uploader,
             "language": language,
             "topic": topic,
-            "published_date": published_date
+            "published_date": published_date,
+            "file_size": file_size
         }
 
         try:
             doc_id = self.files.insert(file_data)
+            self.manager.invalidate('files')
             # Update file index
-            self.manager._file_index[file_id] = doc_id
-            self.manager._file_index[normalized_path] = doc_id
+            self.manager._file_id_index[file_id] = doc_id
+            self.manager._file_path_index[normalized_path] = doc_id
+            self.manager._index_terms(self.manager._publisher_index, doc_id, [source])
             logger.info(f"Created file record and updated index for: {normalized_path}, doc_id: {doc_id}")
             return doc_id
         except Exception as e:
@@ -148,28 +394,79 @@ class FileModel:
             logger.warning(f"Updating operation status: {file_id} => {kwargs['opt_msg']}")
 
         try:
+            self.manager.sync_with_disk()
             file_record = self.get_file_by_id(file_id)
             if not file_record:
                 logger.warning(f"Failed to update file, not found: {file_id}")
                 raise ValueError(f"File not found: {file_id}")
 
-            # If file_path is updated, sync _file_index
-            old_path = file_record['file_path']
-            new_path = updates.get('file_path')
-            if new_path and new_path != old_path:
-                new_path = os.path.normpath(new_path)
-                self.manager._file_index.pop(os.path.normpath(old_path), None)
-                self.manager._file_index[new_path] = file_record.doc_id # type: ignore
-                logger.info(f"Updated file index: {old_path} -> {new_path}, doc_id: {file_record.doc_id}") # type: ignore
-
-            updated = self.files.update(updates, self.query.file_id == file_id)  # type: ignore
+            # Update by doc_id from the index, a query would test every document
+            updated = self.files.update(updates, doc_ids=[file_record.doc_id])  # type: ignore
+            self.manager.invalidate('files')
             if not updated:
                 logger.warning(f"Failed to update file, not found: {file_id}")
                 raise ValueError(f"File not found: {file_id}")
+
+            self._sync_file_indexes(file_record, updates)
         except Exception as e:
             logger.error(f"Failed to update file: {file_id}, error: {e}")
             raise RuntimeError(f"File update failed: {e}") from e
 
+    def update_files(self, updates: List[tuple]) -> None:
+        """Apply (file_id, fields) updates to several files with a single storage write."""
+        merged = {}
+        for file_id, fields in updates:
+            merged.setdefault(file_id, {}).update({k: v for k, v in fields.items() if v is not None})
+        merged = {file_id: fields for file_id, fields in merged.items() if fields}
+        if not merged:
+            return
+
+        try:
+            snapshot = self.manager.get_snapshot('files')
+            records = {}
+            for file_id in merged:
+                file_record = snapshot.get(self.manager._file_id_index.get(file_id))
+                if not file_record:
+                    logger.warning(f"Failed to update file, not found: {file_id}")
+                    raise ValueError(f"File not found: {file_id}")
+                records[file_id] = file_record
+
+            # TinyDB rewrites the whole JSON file per update call, so do them all in one pass over
+            # the indexed doc_ids; each document picks its own fields by file_id
+            self.files.update(
+                lambda doc: doc.update(merged[doc["file_id"]]),
+                doc_ids=[file_record.doc_id for file_record in records.values()]  # type: ignore
+            )
+            self.manager.invalidate('files')
+
+            for file_id, fields in merged.items():
+                self._sync_file_indexes(records[file_id], fields)
+            logger.info(f"Batch updated {len(merged)} file records")
+        except Exception as e:
+            logger.error(f"Failed to batch update files: {e}")
+            raise RuntimeError(f"File batch update failed: {e}") from e
+
+    def _sync_file_indexes(self, file_record: Dict, updates: Dict) -> None:
+        """Keep path, tag and publisher indexes in step with an applied update."""
+        doc_id = file_record.doc_id  # type: ignore
+
+        # If file_path is updated, sync _file_path_index
+        old_path = file_record['file_path']
+        new_path = updates.get('file_path')
+        if new_path and new_path != old_path:
+            new_path = os.path.normpath(new_path)
+            self.manager._file_path_index.pop(os.path.normpath(old_path), None)
+            self.manager._file_path_index[new_path] = doc_id
+            logger.info(f"Updated file index: {old_path} -> {new_path}, doc_id: {doc_id}")
+
+        # Sync inverted indexes if tags or source changed
+        if "tags" in updates:
+            self.manager._unindex_terms(self.manager._tag_index, doc_id, file_record.get("tags"))
+            self.manager._index_terms(self.manager._tag_index, doc_id, updates["tags"])
+        if "source" in updates:
+            self.manager._unindex_terms(self.manager._publisher_index, doc_id, [file_record.get("source")])
+            self.manager._index_terms(self.manager._publisher_index, doc_id, [updates["source"]])
+
     def update_pages_aigc_status(
             self,
             file_id: str,
@@ -189,7 +486,7 @@ class FileModel:
         """
         try:
             # Locate file by ID using index
-            doc_id = self.manager._file_index.get(file_id)
+            doc_id = self.manager._file_id_index.get(file_id)
             if not doc_id:
                 logger.warning(f"File not found: {file_id}")
                 return False
@@ -223,6 +520,7 @@ class FileModel:
             if updated:
                 # Update only pages field
                 self.files.update({'pages': pages}, doc_ids=[doc_id])
+                self.manager.invalidate('files')
                 return True
 
             return False
@@ -234,20 +532,24 @@ class FileModel:
     def delete_file(self, file_id: str) -> None:
         """Delete file record and remove from index."""
         try:
+            self.manager.sync_with_disk()
             file_record = self.get_file_by_id(file_id)
             if not file_record:
                 logger.warning(f"Failed to delete file, not found: {file_id}")
                 raise ValueError(f"File not found: {file_id}")
 
-            remove = self.files.remove(self.query.file_id == file_id)  # type: ignore
+            remove = self.files.remove(doc_ids=[file_record.doc_id])  # type: ignore
+            self.manager.invalidate('files')
             if not remove:
                 logger.warning(f"Failed to delete file, not found: {file_id}")
                 raise ValueError(f"File not found: {file_id}")
 
             # Remove from file index
             file_path = file_record['file_path']
-            self.manager._file_index.pop(file_id, None)
-            self.manager._file_index.pop(os.path.normpath(file_path), None)
+            self.manager._file_id_index.pop(file_id, None)
+            self.manager._file_path_index.pop(os.path.normpath(file_path), None)
+            self.manager._unindex_terms(self.manager._tag_index, file_record.doc_id, file_record.get("tags"))  # type: ignore
+            self.manager._unindex_terms(self.manager._publisher_index, file_record.doc_id, [file_record.get("source")])  # type: ignore
             logger.info(f"Removed file index entries for file_id: {file_id}, file_path: {file_path}")
         except Exception as e:
             logger.error(f"Failed to delete file: {file_id}, error: {e}")
@@ -256,7 +558,10 @@ class FileModel:
     def clean_up_file_pages(self, file_id: str) -> None:
         """Clean up all page records for a file."""
         try:
-            updated = self.files.update({"pages": []}, self.query.file_id == file_id)  # type: ignore
+            self.manager.sync_with_disk()
+            doc_id = self.manager._file_id_index.get(file_id)
+            updated = self.files.update({"pages": []}, doc_ids=[doc_id]) if doc_id is not None else []
+            self.manager.invalidate('files')
             if not updated:
                 logger.warning(f"Failed to delete pages, file not found: {file_id}")
                 raise ValueError(f"File not found: {file_id}")
@@ -264,37 +569,100 @@ class FileModel:
             logger.error(f"Failed to delete pages: {file_id}, error: {e}")
             raise RuntimeError(f"Page deletion failed: {e}") from e
 
-    def add_pages(self, file_id: str, page_data_list: List[Dict]) -> bool:
-        """Add page data in bulk."""
+    def add_pages(self, file_id: str, page_data_list: Iterable[Dict]) -> bool:
+        """Add page data in bulk, accepts any iterable (e.g. a generator) of page records."""
         try:
-            file_record = self.files.get(self.query.file_id == file_id)  # type: ignore
-            if not file_record:
+            self.manager.sync_with_disk()
+            doc_id = self.manager._file_id_index.get(file_id)
+            if doc_id is None:
                 return False
 
-            doc_id = file_record.doc_id
-            current_pages = file_record.get('pages', [])
-            updated_pages = current_pages + page_data_list
-
-            self.files.update({"pages": updated_pages}, doc_ids=[doc_id])
-            return True
+            # Extend the stored list in place within the single update, no copy of existing pages
+            updated = self.files.update(
+                lambda doc: doc.setdefault('pages', []).extend(page_data_list), doc_ids=[doc_id]
+            )
+            self.manager.invalidate('files')
+            return bool(updated)
         except Exception as e:
             logger.error(f"Failed to add pages: {file_id}, error: {e}")
             return False
 
     def get_all_files(self) -> List[Dict]:
-        """Retrieve all file records."""
+        """Retrieve all file records from the in-memory snapshot (read-only)."""
         try:
-            files = self.files.all()
+            files = list(self.manager.get_snapshot('files').values())
             return files
         except Exception as e:
             logger.error(f"Failed to get all files: {e}")
             raise RuntimeError(f"File retrieval failed: {e}") from e
 
-    def is_file_changed(self, file_path: str) -> bool:
-        """Check if file has changed."""
+    def get_doc_ids_by_tags(self, tags: List[str], match_all: bool = False) -> set:
+        """Return doc_ids of files tagged with any (or all) of the given tags using the inverted index."""
+        return self.manager.lookup_terms(self.manager._tag_index, tags, match_all)
+
+    def get_tag_postings(self, tags: List[str]) -> List[set]:
+        """Return the doc_ids tagged with each tag, aligned with tags (read-only)."""
+        return self.manager.term_postings(self.manager._tag_index, tags)
+
+    def get_doc_ids_by_publisher(self, publisher: str) -> set:
+        """Return doc_ids of files whose source contains the given text (case-insensitive)."""
+        self.manager.sync_with_disk()
+        query = self.manager.normalize_term(publisher)
+        return set().union(*(
+            doc_ids for source, doc_ids in self.manager._publisher_index.items() if query in source
+        ))
+
+    @staticmethod
+    def _published_day(published_date: Any) -> Optional[date]:
+        # Day part of a stored published_date, None if missing or unparsable
+        if isinstance(published_date, str):
+            try:
+                published_date = datetime.fromisoformat(published_date)
+            except ValueError:
+                return None
+        return published_date.date() if isinstance(published_date, datetime) else None
+
+    def get_doc_ids_by_date_range(self, start: Optional[date] = None, end: Optional[date] = None) -> set:
+        """Return doc_ids of files published within [start, end] (either bound optional) via a sorted date index."""
+        snapshot = self.manager.get_snapshot('files')
+        if self.manager._date_order is None:
+            dated = sorted(
+                (day, doc_id) for doc_id, doc in snapshot.items()
+                if (day := self._published_day(doc.get("published_date"))) is not None
+            )
+            self.manager._date_order = ([day for day, _ in dated], [doc_id for _, doc_id in dated])
+        days, doc_ids = self.manager._date_order
+        lo = bisect.bisect_left(days, start) if start else 0
+        hi = bisect.bisect_right(days, end) if end else len(days)
+        return set(doc_ids[lo:hi])
+
+    def lowered(self, file: Dict, field: str) -> str:
+        """Lowercased text field of a file record returned by the snapshot readers."""
+        return self.manager.lowered_field('files', file, field)
+
+    def query_files(self, doc_ids=None, **filters: Any) -> List[Dict]:
+        """Retrieve file records (optionally limited to doc_ids) whose fields equal the given values,
+        filtered during the snapshot scan, in table order (read-only)."""
+        try:
+            snapshot = self.manager.get_snapshot('files')
+            docs = snapshot.values() if doc_ids is None else (snapshot[d] for d in sorted(doc_ids) if d in snapshot)
+            return [doc for doc in docs if all(doc.get(k) == v for k, v in filters.items())]
+        except Exception as e:
+            logger.error(f"Failed to query files: {e}")
+            raise RuntimeError(f"File retrieval failed: {e}") from e
+
+    def is_file_changed(self, file_path: str, size_backfill: Optional[List[tuple]] = None) -> bool:
+        """Check if file has changed.
+
+        A record without file_size is checked by hash; when it matches, (file_id, {"file_size": size})
+        is appended to size_backfill (if given) so the caller can store it and skip the hash next time.
+        """
         # Normalize file path for consistency
         normalized_path = os.path.normpath(file_path)
-        if not os.path.exists(normalized_path):
+        try:
+            # One stat call serves the existence check and the mtime/size comparison
+            stat = os.stat(normalized_path)
+        except OSError:
             logger.warning(f"File deleted or not found: {normalized_path}")
             return True
 
@@ -309,17 +677,24 @@ class FileModel:
             return True
 
         try:
-            current_hash = self.calculate_md5(normalized_path)
-            current_mtime = os.path.getmtime(normalized_path)
-
-            if file_record["file_hash"] != current_hash:
-                logger.warning(f"File hash changed: {normalized_path}")
+            # Cheap stat checks first, only hash when the record has no size to compare against
+            if abs(file_record["last_modified"] - stat.st_mtime) > 0.001:
+                logger.warning(f"File modification time changed: {normalized_path}")
                 return True
 
-            if abs(file_record["last_modified"] - current_mtime) > 0.001:
-                logger.warning(f"File modification time changed: {normalized_path}")
+            recorded_size = file_record.get("file_size")
+            if recorded_size is not None:
+                if recorded_size != stat.st_size:
+                    logger.warning(f"File size changed: {normalized_path}")
+                    return True
+                return False
+
+            if file_record["file_hash"] != self.calculate_md5(normalized_path):
+                logger.warning(f"File hash changed: {normalized_path}")
                 return True
 
+            if size_backfill is not None:
+                size_backfill.append((file_record["file_id"], {"file_size": stat.st_size}))
             return False
         except Exception as e:
             logger.error(f"Failed to check file change: {normalized_path}, error: {e}")
@@ -327,34 +702,43 @@ class FileModel:
 
     @staticmethod
     def calculate_md5(file_path: str) -> str:
-        """Calculate MD5 hash of a file."""
-        hash_md5 = hashlib.md5()
+        """Calculate MD5 hash of a file, memoized while its size and mtime are unchanged."""
         try:
+            stat = os.stat(file_path)
+        except OSError as e:
+            logger.error(f"Failed to calculate MD5: {file_path}, error: {e}")
+            raise IOError(f"MD5 calculation failed: {e}") from e
+        return FileModel._calculate_md5(file_path, stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _calculate_md5(file_path: str, size: int, mtime_ns: int) -> str:
+        # size and mtime_ns are only part of the cache key
+        try:
+            # file_digest reads in large blocks in C and releases the GIL while hashing
             with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+                return hashlib.file_digest(f, "md5").hexdigest()
         except Exception as e:
             logger.error(f"Failed to calculate MD5: {file_path}, error: {e}")
             raise IOError(f"MD5 calculation failed: {e}") from e
 
     def get_files_by_ids(self, file_ids: List[str]) -> List[Dict]:
-        """Batch retrieve file records by file IDs using index."""
+        """Batch retrieve file records by file IDs from the snapshot, in the given order (read-only)."""
         try:
-            doc_ids = [self.manager._file_index.get(fid) for fid in file_ids]
-            doc_ids = [did for did in doc_ids if did is not None]
-            return self.files.get(doc_ids=doc_ids)
+            snapshot = self.manager.get_snapshot('files')
+            docs = (snapshot.get(self.manager._file_id_index.get(fid)) for fid in file_ids)
+            return [doc for doc in docs if doc is not None]
         except Exception as e:
             logger.error(f"Failed to batch query files: {e}")
             return []
 
 class ContentModel:
     """Model for content metadata storage."""
+
     def __init__(self):
         self.manager = TinyDBManager()
         self.db = self.manager.db
         self.contents = self.db.table('contents')
-        self.query = Query()
 
     def create_content(
             self,
@@ -369,6 +753,7 @@ class ContentModel:
     ) -> str:
         """Create a new content record and update index."""
         page_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
         content_data = {
             "page_id": page_id,
             "file_id": file_id,
@@ -378,21 +763,58 @@ class ContentModel:
             "property": prop,
             "abstract": abstract,
             "keywords": keywords or [],
-            "created_at": kwargs.get("created_at") or datetime.now().isoformat(),
-            "updated_at": kwargs.get("updated_at") or datetime.now().isoformat()
+            "created_at": kwargs.get("created_at") or now,
+            "updated_at": kwargs.get("updated_at") or now
         }
 
         try:
             doc_id = self.contents.insert(content_data)
-            # Update content index
-            self.manager._content_index[page_id] = doc_id
-            self.manager._content_index.setdefault(file_id, set()).add(doc_id)
+            self.manager.invalidate('contents')
+            self._index_content(doc_id, content_data)
             logger.info(f"Created content record and updated index for page_id: {page_id}, file_id: {file_id}, doc_id: {doc_id}")
             return page_id
         except Exception as e:
             logger.error(f"Failed to create content: page_id: {page_id}, error: {e}")
             raise RuntimeError(f"Content creation failed: {e}") from e
 
+    def create_contents(self, items: List[Dict]) -> List[str]:
+        """Create several content records with a single insert, items take create_content's arguments."""
+        if not items:
+            return []
+        now = datetime.now().isoformat()
+        records = [
+            {
+                "page_id": str(uuid.uuid4()),
+                "file_id": item["file_id"],
+                "page_number": item["page_number"],
+                "content": item["content"],
+                "title": item.get("title", ""),
+                "property": item.get("prop", ""),
+                "abstract": item.get("abstract", ""),
+                "keywords": item.get("keywords") or [],
+                "created_at": item.get("created_at") or now,
+                "updated_at": item.get("updated_at") or now
+            }
+            for item in items
+        ]
+
+        try:
+            doc_ids = self.contents.insert_multiple(records)
+            self.manager.invalidate('contents')
+            for doc_id, content_data in zip(doc_ids, records):
+                self._index_content(doc_id, content_data)
+            logger.info(f"Created {len(records)} content records and updated index")
+            return [content_data["page_id"] for content_data in records]
+        except Exception as e:
+            logger.error(f"Failed to batch create contents: {e}")
+            raise RuntimeError(f"Content batch creation failed: {e}") from e
+
+    def _index_content(self, doc_id: int, content_data: Dict) -> None:
+        """Add a newly inserted content record to the page, file and keyword indexes."""
+        self.manager._page_id_index[content_data["page_id"]] = doc_id
+        self.manager._file_contents_index.setdefault(content_data["file_id"], set()).add(doc_id)
+        self.manager._index_terms(self.manager._keyword_index, doc_id, content_data["keywords"])
+
     def update_content(self, page_id: str, **kwargs) -> None:
         """Update content record with allowed fields."""
         allowed_fields = ["content", "keywords", "updated_at", "title", "property", "abstract"]
@@ -400,10 +822,19 @@ class ContentModel:
         update_data["updated_at"] = datetime.now().isoformat()
 
         try:
-            updated = self.contents.update(update_data, self.query.page_id == page_id)  # type: ignore
-            if not updated:
+            self.manager.sync_with_disk()
+            doc_id = self.manager._page_id_index.get(page_id)
+            if doc_id is None:
                 logger.warning(f"Failed to update content, not found: page_id: {page_id}")
                 raise ValueError(f"Content not found: {page_id}")
+            previous = self.contents.get(doc_id=doc_id) if "keywords" in update_data else None
+            self.contents.update(update_data, doc_ids=[doc_id])
+            self.manager.invalidate('contents')
+
+            # Sync keyword index
+            if previous is not None:
+                self.manager._unindex_terms(self.manager._keyword_index, previous.doc_id, previous.get("keywords"))  # type: ignore
+                self.manager._index_terms(self.manager._keyword_index, previous.doc_id, update_data["keywords"])  # type: ignore
         except Exception as e:
             logger.error(f"Failed to update content: page_id: {page_id}, error: {e}")
             raise RuntimeError(f"Content update failed: {e}") from e
@@ -411,7 +842,7 @@ class ContentModel:
     def get_content_by_page_id(self, page_id: str) -> Optional[Dict]:
         """Retrieve content record by page ID using index."""
         try:
-            doc_id = self.manager._content_index.get(page_id)
+            doc_id = self.manager._page_id_index.get(page_id)
             if doc_id is None:
                 logger.warning(f"Content record not found: {page_id}")
                 return None
@@ -423,12 +854,12 @@ class ContentModel:
     def get_contents_by_file_id(self, file_id: str) -> List[Dict]:
         """Retrieve all content records by file ID using index with batch query."""
         try:
-            doc_ids = self.manager._content_index.get(file_id, set())
+            doc_ids = self.manager._file_contents_index.get(file_id, set())
             if not doc_ids:
                 logger.warning(f"No content records found for file: {file_id}")
                 return []
             # Batch query using doc_ids
-            results = self.contents.get(doc_ids=list(doc_ids))
+            results = self.contents.get(doc_ids=sorted(doc_ids))
             return [r for r in results if r is not None]
         except Exception as e:
             logger.error(f"Failed to query contents: {file_id}, error: {e}")
@@ -437,23 +868,26 @@ class ContentModel:
     def delete_content(self, page_id: str) -> bool:
         """Delete content record by page ID and remove from index."""
         try:
+            self.manager.sync_with_disk()
             content_record = self.get_content_by_page_id(page_id)
             if not content_record:
                 logger.warning(f"Failed to delete content, not found: page_id: {page_id}")
                 return False
 
-            removed = self.contents.remove(self.query.page_id == page_id)  # type: ignore
+            removed = self.contents.remove(doc_ids=[content_record.doc_id])  # type: ignore
+            self.manager.invalidate('contents')
             if not removed:
                 logger.warning(f"Failed to delete content, not found: page_id: {page_id}")
                 return False
 
             # Remove from content index
             file_id = content_record['file_id']
-            doc_id = self.manager._content_index.pop(page_id, None)
-            if doc_id and file_id in self.manager._content_index:
-                self.manager._content_index[file_id].discard(doc_id)
-                if not self.manager._content_index[file_id]:
-                    self.manager._content_index.pop(file_id)
+            doc_id = self.manager._page_id_index.pop(page_id, None)
+            self.manager._unindex_terms(self.manager._keyword_index, content_record.doc_id, content_record.get("keywords"))  # type: ignore
+            if doc_id and file_id in self.manager._file_contents_index:
+                self.manager._file_contents_index[file_id].discard(doc_id)
+                if not self.manager._file_contents_index[file_id]:
+                    self.manager._file_contents_index.pop(file_id)
             logger.info(f"Removed content index entries for page_id: {page_id}, file_id: {file_id}")
             return True
         except Exception as e:
@@ -463,8 +897,10 @@ class ContentModel:
     def delete_contents_by_file_id(self, file_id: str) -> int:
         """Delete all content records by file ID and remove from index."""
         try:
+            self.manager.sync_with_disk()
             contents = self.get_contents_by_file_id(file_id)
-            removed_count = len(self.contents.remove(self.query.file_id == file_id))  # type: ignore
+            removed_count = len(self.contents.remove(doc_ids=[content.doc_id for content in contents])) if contents else 0
+            self.manager.invalidate('contents')
             if not removed_count:
                 logger.warning(f"Failed to delete contents, no records found: file_id: {file_id}")
                 return 0
@@ -472,20 +908,53 @@ class ContentModel:
             # Remove from content index
             for content in contents:
                 page_id = content['page_id']
-                self.manager._content_index.pop(page_id, None)
-            self.manager._content_index.pop(file_id, None)
+                self.manager._page_id_index.pop(page_id, None)
+                self.manager._unindex_terms(self.manager._keyword_index, content.doc_id, content.get("keywords"))
+            self.manager._file_contents_index.pop(file_id, None)
             logger.info(f"Removed {removed_count} content index entries for file_id: {file_id}")
             return removed_count
         except Exception as e:
             logger.error(f"Failed to delete contents: file_id: {file_id}, error: {e}")
             return 0
 
+    def get_doc_ids_by_file_ids(self, file_ids: List[str]) -> set:
+        """Return doc_ids of the contents of several files using the index."""
+        self.manager.sync_with_disk()
+        return set().union(*(self.manager._file_contents_index.get(file_id, set()) for file_id in file_ids))
+
+    def get_keyword_postings(self, keywords: List[str]) -> List[set]:
+        """Return the doc_ids of contents with each keyword, aligned with keywords (read-only)."""
+        return self.manager.term_postings(self.manager._keyword_index, keywords)
+
+    def get_doc_ids_by_keywords(self, keywords: List[str], match_all: bool = False) -> set:
+        """Return doc_ids of contents with any (or all) of the given keywords using the inverted index."""
+        return self.manager.lookup_terms(self.manager._keyword_index, keywords, match_all)
+
+    def lowered(self, content: Dict, field: str) -> str:
+        """Lowercased text field of a content record returned by the snapshot readers."""
+        return self.manager.lowered_field('contents', content, field)
+
+    def query_contents(self, doc_ids=None, **filters: Any) -> List[Dict]:
+        """Retrieve content records (optionally limited to doc_ids) whose fields equal the given values,
+        filtered during the snapshot scan, in table order (read-only)."""
+        try:
+            snapshot = self.manager.get_snapshot('contents')
+            docs = snapshot.values() if doc_ids is None else (snapshot[d] for d in sorted(doc_ids) if d in snapshot)
+            return [doc for doc in docs if all(doc.get(k) == v for k, v in filters.items())]
+        except Exception as e:
+            logger.error(f"Failed to query contents: {e}")
+            raise RuntimeError(f"Content retrieval failed: {e}") from e
+
+    def get_contents_by_file_ids(self, file_ids: List[str]) -> List[Dict]:
+        """Retrieve content records of several files from the snapshot, in table order (read-only)."""
+        return self.query_contents(self.get_doc_ids_by_file_ids(file_ids))
+
     def get_contents_by_page_ids(self, page_ids: List[str]) -> List[Dict]:
-        """Batch retrieve content records by page IDs using index."""
+        """Batch retrieve content records by page IDs from the snapshot, in the given order (read-only)."""
         try:
-            doc_ids = [self.manager._content_index.get(pid) for pid in page_ids]
-            doc_ids = [did for did in doc_ids if did is not None]
-            return self.contents.get(doc_ids=doc_ids)
+            snapshot = self.manager.get_snapshot('contents')
+            docs = (snapshot.get(self.manager._page_id_index.get(pid)) for pid in page_ids)
+            return [doc for doc in docs if doc is not None]
         except Exception as e:
             logger.error(f"Failed to batch query contents: {e}")
             return []
@@ -1,11 +1,27 @@
-import base64
+import hashlib
 import os
-import json
 import asyncio
+import threading
 import time
+from json import JSONDecoder, dumps as json_dumps
+from collections import deque
 from datetime import datetime
+from operator import itemgetter
+from typing import Optional
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, APIStatusError, APITimeoutError, RateLimitError
+
+try:
+    # Optional: orjson parses VLM responses several times faster than the json module
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    # Optional: pybase64 encodes page images with SIMD, several times faster than the base64 module
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
 
 from models import FileModel, ContentModel
 from config import config
@@ -14,7 +30,100 @@ from logger import setup_logger
 
 logger = setup_logger(__name__)
 
+_JSON_DECODER = JSONDecoder()
+
+class AIMDLimiter:
+    """Adaptive concurrency limit for VLM calls (additive increase, multiplicative decrease).
+
+    Used like an asyncio.Semaphore. The limit grows by `step` while the average
+    latency stays under `target_latency`, and halves on 429/5xx/timeouts or when
+    the provider reports less than `low_quota` of its request quota remaining.
+    """
+
+    def __init__(
+            self,
+            initial: int = 2,
+            min_limit: int = 1,
+            max_limit: int = 8,
+            target_latency: float = 20.0,
+            step: float = 0.5,
+            low_quota: float = 0.1,
+            window: int = 10
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.step = step
+        self.low_quota = low_quota
+        self._latencies = deque(maxlen=window)
+        self._in_flight = 0
+        self._resume_at = 0.0  # monotonic time before which no new request is sent
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < int(self.limit))
+            self._in_flight += 1
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def on_response(self, latency: float, headers) -> None:
+        """Record a successful call and adjust the limit from latency and quota headers."""
+        self._latencies.append(latency)
+        remaining = self._header_float(headers, "x-ratelimit-remaining-requests", "x-ratelimit-remaining")
+        total = self._header_float(headers, "x-ratelimit-limit-requests", "x-ratelimit-limit")
+        if remaining is not None and total and remaining / total < self.low_quota:
+            self._decrease(f"quota low ({remaining:.0f}/{total:.0f})")
+            return
+        if sum(self._latencies) / len(self._latencies) <= self.target_latency:
+            self.limit = min(self.max_limit, self.limit + self.step)
+
+    def on_error(self, headers=None) -> None:
+        """Back off after a rate-limit, server error or timeout."""
+        retry_after = self._retry_after(headers) if headers is not None else None
+        if retry_after:
+            self._resume_at = max(self._resume_at, time.monotonic() + retry_after)
+        self._decrease("rate limited or server error")
+
+    def _decrease(self, reason: str) -> None:
+        new_limit = max(self.min_limit, self.limit * 0.5)
+        if int(new_limit) < int(self.limit):
+            logger.warning(f"Reducing VLM concurrency {int(self.limit)} -> {int(new_limit)}: {reason}")
+        self.limit = new_limit
+
+    @staticmethod
+    def _header_float(headers, *names) -> Optional[float]:
+        for name in names:
+            value = headers.get(name)
+            if value is not None:
+                try:
+                    return float(value)
+                except ValueError:
+                    continue
+        return None
+
+    @classmethod
+    def _retry_after(cls, headers) -> Optional[float]:
+        # Seconds to wait, from `retry-after` or an epoch-milliseconds `x-ratelimit-reset`
+        retry_after = cls._header_float(headers, "retry-after")
+        if retry_after is not None:
+            return retry_after
+        reset_ms = cls._header_float(headers, "x-ratelimit-reset")
+        if reset_ms is not None:
+            return max(0.0, reset_ms / 1000 - time.time())
+        return None
+
 class IMGRecognizer:
+    READ_AHEAD_FACTOR = 2  # Pages holding image data at once, as a multiple of the VLM concurrency ceiling
+
     def __init__(self):
         self.file_model = FileModel()
         self.content_model = ContentModel()
@@ -23,7 +132,11 @@ class IMGRecognizer:
             base_url=config.vlm_base_url,
         )
         self.model = config.vlm_model_name
-        self.prompt_cache = {}  # Cache for prompt templates
+        self.prompt_cache = {}  # Per-model prompt parts: {model: (system message, user text part, key digest)}
+        self.limiter: Optional[AIMDLimiter] = None
+        self.read_ahead: Optional[asyncio.Semaphore] = None
+        self.cache_dir = config.vlm_cache_dir
+        self.cache_ttl = config.vlm_cache_ttl_days * 86400
 
     async def image_understanding(self):
         """Process unidentified pages using VLM model."""
@@ -43,57 +156,162 @@ class IMGRecognizer:
 
         logger.info(f"Starting to process {len(file_pages)} files with {len(all_pages)} pages.")
 
-        # Use semaphore to limit concurrent API calls
-        semaphore = asyncio.Semaphore(2)
+        # Limit concurrent API calls, adapting to latency and provider rate limits
+        max_concurrency = max(1, config.vlm_max_concurrency)
+        self.limiter = AIMDLimiter(initial=min(2, max_concurrency), max_limit=max_concurrency)
+        # Bound how many pages have their image loaded while queued for a VLM slot, so memory
+        # doesn't grow with the number of pages in the run
+        self.read_ahead = asyncio.Semaphore(max_concurrency * self.READ_AHEAD_FACTOR)
 
         # Process pages one by one with concurrency control
-        tasks = []
+        tasks = [asyncio.create_task(self._run_page(page, self.limiter)) for page in all_pages]
+
+        # Buffer page results per file and update each file as soon as its last page finishes,
+        # so DB writes overlap with pages still in flight
+        pending_pages = {}
         for page in all_pages:
-            task = asyncio.create_task(self._process_page_with_retry(page, semaphore))
-            tasks.append(task)
+            pending_pages[page["file_id"]] = pending_pages.get(page["file_id"], 0) + 1
+        file_results = {}
+        success_count = 0
+        for next_done in asyncio.as_completed(tasks):
+            page, result = await next_done
+            file_id = page["file_id"]
+            if isinstance(result, dict):
+                file_results.setdefault(file_id, {})[page["page_number"]] = result
+            pending_pages[file_id] -= 1
+            if pending_pages[file_id]:
+                continue
+            page_results = file_results.pop(file_id, None)
+            if not page_results:
+                continue
+            try:
+                await self._update_models(file_id, page_results)
+                success_count += sum(1 for ai_data in page_results.values() if ai_data)
+            except Exception as e:
+                logger.error(f"Failed to update file {file_id} with {len(page_results)} pages: {str(e)}")
+        logger.info(f"Processing completed. Success: {success_count} pages, Failed: {len(all_pages) - success_count} pages.")
+
+    async def _run_page(self, page: dict, limiter: AIMDLimiter) -> tuple:
+        """Process a page and pair the result with it, as_completed yields results out of order."""
+        try:
+            async with self.read_ahead:
+                return page, await self._process_page_with_retry(page, limiter)
+        except Exception as e:
+            logger.error(f"Failed to process file {page['file_id']} page {page['page_number']}: {str(e)}")
+            return page, None
 
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        success_count = sum(1 for result in results if not isinstance(result, Exception) and result)
-        logger.info(f"Processing completed. Success: {success_count} pages, Failed: {len(results) - success_count} pages.")
+    async def _process_page_with_retry(self, page: dict, limiter: AIMDLimiter) -> Optional[dict]:
+        """Process page with retry mechanism.
 
-    async def _process_page_with_retry(self, page: dict, semaphore: asyncio.Semaphore):
-        """Process page with retry mechanism."""
+        Returns the parsed AI data, an empty dict when the page failed but should be marked
+        as processed, or None when it should be left for a later run.
+        """
         max_retries = 3
         retry_delay = 5.0
-
-        async with semaphore:
-            for attempt in range(max_retries):
-                try:
-                    ai_response = await self.process_page(page)
+        # Read the image once, in a worker thread, while the page is still queued for a VLM slot
+        # (the caller's read-ahead bound limits how many pages do this at once);
+        # the same bytes feed the cache key and every request attempt
+        image_bytes = await asyncio.to_thread(self._read_image, page.get("page_path"))
+        cache_key = self._response_cache_key(image_bytes)
+        base64_image = None  # Encoded on the first cache miss, reused by later attempts
+
+        for attempt in range(max_retries):
+            try:
+                # Cache file I/O runs in a worker thread like the image read
+                ai_data = await asyncio.to_thread(self._load_cached_response, cache_key)
+                if ai_data is None:
+                    # Only the VLM request holds a concurrency slot, so pages waiting
+                    # on a retry back-off or a DB write don't block other pages
+                    if base64_image is None and image_bytes is not None:
+                        # Multi-megabyte encode, off the event loop and under the same read-ahead bound
+                        # as the read; the raw bytes aren't needed after it, so only one copy is held
+                        base64_image = await asyncio.to_thread(self._image_to_base64, image_bytes)
+                        image_bytes = None
+                    async with limiter:
+                        ai_response = await self.process_page(page, base64_image)
                     if not ai_response:
                         raise ValueError("Empty AI response")
                     ai_data = self._parse_ai_response(ai_response)
                     if not ai_data:
                         raise ValueError("Failed to parse AI response")
-                    await self._update_models(page, ai_data)
-                    return True
-
-                except Exception as e:
-                    logger.warning(
-                        f"Attempt {attempt + 1}/{max_retries} failed for file {page['file_id']} page {page['page_number']}: {str(e)}")
-                    if attempt == max_retries - 1:
-                        if "429" in str(e):
-                            logger.error(
-                                f"Max retries reached due to rate limit for file {page['file_id']} page {page['page_number']}: {str(e)}. Skipping further processing.")
-                            return False
-                        else:
-                            logger.error(
-                                f"Max retries reached for file {page['file_id']} page {page['page_number']}: {str(e)}. Marking as processed.")
-                            await self._update_models(page, {})
-                            return False
+                    await asyncio.to_thread(self._store_cached_response, cache_key, ai_data)
+                return ai_data
 
+            except Exception as e:
+                logger.warning(
+                    f"Attempt {attempt + 1}/{max_retries} failed for file {page['file_id']} page {page['page_number']}: {str(e)}")
+                if attempt == max_retries - 1:
                     if "429" in str(e):
-                        reset_time = int(
-                            e.args[0].get('metadata', {}).get('headers', {}).get('X-RateLimit-Reset', 0)) - int(time.time() * 1000)
-                        if reset_time > 0:
-                            await asyncio.sleep(reset_time / 1000 + 1)
-                    await asyncio.sleep(retry_delay * (2 ** attempt))
-        return False
+                        logger.error(
+                            f"Max retries reached due to rate limit for file {page['file_id']} page {page['page_number']}: {str(e)}. Skipping further processing.")
+                        return None
+                    else:
+                        logger.error(
+                            f"Max retries reached for file {page['file_id']} page {page['page_number']}: {str(e)}. Marking as processed.")
+                        return {}
+
+                if "429" in str(e):
+                    reset_time = int(
+                        e.args[0].get('metadata', {}).get('headers', {}).get('X-RateLimit-Reset', 0)) - int(time.time() * 1000)
+                    if reset_time > 0:
+                        await asyncio.sleep(reset_time / 1000 + 1)
+                await asyncio.sleep(retry_delay * (2 ** attempt))
+        return None
+
+    def _prompt_parts(self) -> tuple:
+        """Request parts that only depend on the model's prompt, built once per model."""
+        parts = self.prompt_cache.get(self.model)
+        if parts is None:
+            prompt = Prompts.get_prompt(self.model)
+            digest = hashlib.blake2b(digest_size=16)
+            for part in (self.model, prompt["system"], prompt["user"]):
+                digest.update(part.encode("utf-8"))
+                digest.update(b"\0")
+            parts = self.prompt_cache[self.model] = (
+                {"role": "system", "content": [{"type": "text", "text": prompt["system"]}]},
+                {"type": "text", "text": prompt["user"]},
+                digest,  # Hashed model and prompt, copied per page before adding the image
+            )
+        return parts
+
+    def _response_cache_key(self, image_bytes: Optional[bytes]) -> Optional[str]:
+        """Content address of a page request: model, prompt and image bytes."""
+        if image_bytes is None:
+            return None
+        digest = self._prompt_parts()[2].copy()
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def _load_cached_response(self, cache_key: Optional[str]) -> Optional[dict]:
+        """Return the cached parsed response, or None on a miss or expired entry (which is removed)."""
+        if not cache_key:
+            return None
+        cache_path = os.path.join(self.cache_dir, f"{cache_key}.json")
+        try:
+            if time.time() - os.path.getmtime(cache_path) > self.cache_ttl:
+                os.remove(cache_path)
+                return None
+            with open(cache_path, "rb") as fp:
+                data = json_loads(fp.read())
+        except (OSError, ValueError):
+            return None
+        logger.debug(f"VLM cache hit: {cache_key}")
+        return data if isinstance(data, dict) and data else None
+
+    def _store_cached_response(self, cache_key: Optional[str], ai_data: dict) -> None:
+        """Persist a parsed response; cache failures never fail the page."""
+        if not cache_key:
+            return
+        cache_path = os.path.join(self.cache_dir, f"{cache_key}.json")
+        # Per-thread temp name, pages with identical images may store the same key concurrently
+        tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as fp:
+                fp.write(json_dumps(ai_data, ensure_ascii=False))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"Failed to write VLM cache entry {cache_key}: {str(e)}")
 
     @staticmethod
     def _parse_ai_response(ai_response: str) -> dict:
@@ -102,28 +320,41 @@ class IMGRecognizer:
             logger.warning(f"Skipping parse for failed response: {ai_response}")
             return {}
         try:
+            # Fast path: the response is a bare JSON object, no need to scan for braces
+            data = json_loads(ai_response)
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+        try:
+            # Decode exactly one object from the first brace, prose around it is ignored
             json_start = ai_response.find('{')
-            json_end = ai_response.rfind('}') + 1
-            json_str = ai_response[json_start:json_end]
-            return json.loads(json_str)
+            if json_start < 0:
+                raise ValueError("no JSON object found")
+            data, _ = _JSON_DECODER.raw_decode(ai_response, json_start)
+            return data
         except Exception as e:
             logger.error(f"JSON parsing failed: {e}, Response: {ai_response}")
             return {}
 
-    async def _update_models(self, page: dict, ai_data: dict):
-        """Update FileModel and ContentModel with AI data."""
-        file_id = page["file_id"]
-        page_number = page["page_number"]
+    async def _update_models(self, file_id: str, page_results: dict):
+        """Update FileModel and ContentModel with the AI data of several pages of one file.
+
+        Args:
+            file_id: File the pages belong to.
+            page_results: {page_number: ai_data}, an empty ai_data only marks the page processed.
+        """
         now = datetime.now().isoformat()
 
         file_record = self.file_model.get_file_by_id(file_id)
         if not file_record:
             raise ValueError(f"File ID not found: {file_id}")
 
-        updated_pages = []
-        page_found = False
+        # One walk over the pages, results looked up by page number
+        found_pages = set()
         for p in file_record["pages"]:
-            if p["page_number"] == page_number:
+            ai_data = page_results.get(p["page_number"])
+            if ai_data is not None:
                 p.update({
                     "is_aigc": True,
                     "processed_at": now,
@@ -132,93 +363,101 @@ class IMGRecognizer:
                     "abstract": ai_data.get("abstract", ""),
                     "keywords": ai_data.get("keywords", [])
                 })
-                page_found = True
-            updated_pages.append(p)
-
-        if not page_found:
-            raise ValueError(f"Page {page_number} not found in file")
+                found_pages.add(p["page_number"])
 
-        self.file_model.files.update(
-            {"pages": updated_pages},
-            self.file_model.query.file_id == file_id
-        )
-
-        updated_file_record = self.file_model.get_file_by_id(file_id)
-        if not updated_file_record:
-            raise ValueError(f"Updated file ID not found: {file_id}")
+        missing_pages = page_results.keys() - found_pages
+        if missing_pages:
+            logger.warning(f"Pages {sorted(missing_pages)} not found in file {file_id}")
 
-        all_keywords = [kw for p in updated_file_record["pages"] for kw in p.get("keywords", []) if kw]
-        unique_keywords = list(set(all_keywords))
-
-        abstracts = [p["abstract"] for p in sorted(updated_file_record["pages"], key=lambda x: x["page_number"]) if p.get("abstract")]
-        file_desc = "\n".join(abstracts)
+        # Dedupe case-insensitively in one pass, keeping the first spelling seen
+        seen_keywords = {}
+        for p in file_record["pages"]:
+            for kw in p.get("keywords", []):
+                if kw and kw.strip():
+                    seen_keywords.setdefault(kw.strip().lower(), kw.strip())
+        unique_keywords = list(seen_keywords.values())
 
-        self.file_model.files.update(
-            {"tags": unique_keywords, "file_desc": file_desc},
-            self.file_model.query.file_id == file_id
+        file_desc = "\n".join(
+            p["abstract"] for p in sorted(file_record["pages"], key=itemgetter("page_number")) if p.get("abstract")
         )
 
-        if ai_data:
-            content_data = {
-                "file_id": file_id,
-                "page_number": page_number,
-                "content": ai_data.get("content", ""),
-                "title": ai_data.get("title", ""),
-                "prop": ai_data.get("property", ""),
-                "abstract": ai_data.get("abstract", ""),
-                "keywords": ai_data.get("keywords", []),
-                "created_at": now
-            }
-
-
-            existing_content = self.content_model.contents.get(
-                (self.content_model.query.file_id == file_id) &
-                (self.content_model.query.page_number == page_number)
-            )
+        # Page, tag and content updates land in a single DB file rewrite
+        with self.file_model.deferred_writes():
+            # Through the model so the tag index stays in sync
+            self.file_model.update_file(file_id, pages=file_record["pages"], tags=unique_keywords, file_desc=file_desc)
+
+            existing_contents = {}
+            # Index-backed lookup, a snapshot here would be rebuilt from the pending writes for every file
+            for content in self.content_model.get_contents_by_file_id(file_id):
+                existing_contents.setdefault(content["page_number"], content["page_id"])
+
+            new_contents = []
+            for page_number, ai_data in page_results.items():
+                if not ai_data or page_number in missing_pages:
+                    continue
+                content_data = {
+                    "file_id": file_id,
+                    "page_number": page_number,
+                    "content": ai_data.get("content", ""),
+                    "title": ai_data.get("title", ""),
+                    "prop": ai_data.get("property", ""),
+                    "abstract": ai_data.get("abstract", ""),
+                    "keywords": ai_data.get("keywords", []),
+                    "created_at": now
+                }
+
+                page_id = existing_contents.get(page_number)
+                if page_id:
+                    update_data = {k: v for k, v in content_data.items() if k != "created_at"}
+                    self.content_model.update_content(page_id, **update_data)
+                    logger.debug(f"Updated content for file {file_id} page {page_number}")
+                else:
+                    new_contents.append(content_data)
+                    logger.debug(f"Created content for file {file_id} page {page_number}")
 
-            if existing_content:
-                update_data = {k: v for k, v in content_data.items() if k != "created_at"}
-                self.content_model.update_content(existing_content["page_id"], **update_data)
-                logger.debug(f"Updated content for file {file_id} page {page_number}")
-            else:
-                self.content_model.create_content(**content_data)
-                logger.debug(f"Created content for file {file_id} page {page_number}")
+                logger.info(f"Updated file {file_id} page {page_number}")
 
-            logger.info(f"Updated file {file_id} page {page_number}")
+            # New pages go in with one insert instead of one per page
+            self.content_model.create_contents(new_contents)
 
-    async def process_page(self, page: dict) -> str:
+    async def process_page(self, page: dict, base64_image: Optional[str]) -> str:
         """Process a single page and get AI description."""
-        page_path = page.get("page_path")
-        if not page_path or not os.path.exists(page_path):
-            logger.warning(f"Page image not found: {page_path}")
+        if base64_image is None:
+            logger.warning(f"Page image not found: {page.get('page_path')}")
             return f"[Missing page {page.get('page_number')}]"
 
-        base64_image = self._image_to_base64(page_path)
         if not base64_image:
             return ""
 
-        if self.model not in self.prompt_cache:
-            self.prompt_cache[self.model] = Prompts.get_prompt(self.model)
-        prompt = self.prompt_cache[self.model]
-
+        # Only the image part is built per page, the prompt parts are shared
+        system_message, user_text, _ = self._prompt_parts()
         messages = [
-            {"role": "system", "content": [{"type": "text", "text": prompt["system"]}]},
+            system_message,
             {"role": "user", "content": [
                 {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}},
-                {"type": "text", "text": prompt["user"]}
+                user_text
             ]}
         ]
 
         try:
-            response = await self.vlm_client.chat.completions.create(
+            started = time.monotonic()
+            raw_response = await self.vlm_client.chat.completions.with_raw_response.create(
                 model=self.model,
                 messages=messages, # type: ignore
                 temperature=0.3,
                 max_tokens=2000, # Original: 2500
                 timeout = 30.0
             )
+            if self.limiter:
+                self.limiter.on_response(time.monotonic() - started, raw_response.headers)
+            response = raw_response.parse()
             return response.choices[0].message.content
         except Exception as e:
+            if self.limiter and (
+                    isinstance(e, (RateLimitError, APITimeoutError))
+                    or (isinstance(e, APIStatusError) and e.status_code >= 500)
+            ):
+                self.limiter.on_error(e.response.headers if isinstance(e, APIStatusError) else None)
             logger.error(f"Failed to process page {page['page_number']}: {str(e)}")
             return f"[Processing failed P{page['page_number']}]"
 
@@ -238,13 +477,17 @@ class IMGRecognizer:
         return result
 
     @staticmethod
-    def _image_to_base64(image_path: str) -> str:
-        """Convert image to base64 synchronously."""
-        if not os.path.exists(image_path):
-            logger.warning(f"Image not found: {image_path}")
-            return ""
+    def _read_image(image_path: Optional[str]) -> Optional[bytes]:
+        """Read image bytes synchronously, None when the file is missing."""
+        if not image_path or not os.path.exists(image_path):
+            return None
         with open(image_path, "rb") as fp:
-            return base64.b64encode(fp.read()).decode('utf-8')
+            return fp.read()
+
+    @staticmethod
+    def _image_to_base64(image_bytes: bytes) -> str:
+        """Convert image bytes to base64."""
+        return b64encode(image_bytes).decode('ascii')
 
 if __name__ == "__main__":
     recognizer = IMGRecognizer()